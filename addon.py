@@ -1,11 +1,15 @@
+import json
+
 import xbmcaddon
 import xbmcgui
- 
+
 addon       = xbmcaddon.Addon()
 addonname   = addon.getAddonInfo('name')
 
-# Set a string variable to use 
-line1 = "Hello World! We can write anything we want here Using Python"
+# Metrics published by the service (see resources/lib/helper/metrics.py)
+metrics = xbmcgui.Window(10000).getProperty('jellyskip.metrics')
 
-# Launch a dialog box in kodi showing the string variable 'line1' as the contents
-xbmcgui.Dialog().ok(addonname, line1)
+if metrics:
+    xbmcgui.Dialog().textviewer(addonname, json.dumps(json.loads(metrics), indent=2))
+else:
+    xbmcgui.Dialog().ok(addonname, "No metrics published yet, the service publishes them after playback stops.")
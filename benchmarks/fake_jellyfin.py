@@ -0,0 +1,271 @@
+"""
+Local HTTP server imitating the Jellyfin endpoints used by Jellyskip, with synthetic MediaSegments payloads
+of configurable size and an artificial response latency. Also serves the Jellyfin websocket at /socket,
+which pushes LibraryChanged messages on request and can drop its connections to test reconnecting.
+"""
+import base64
+import hashlib
+import json
+import queue
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+TICKS_PER_SECOND = 10000000
+DURATION_SECONDS = 2700
+# Size of the fake media files, about 4.4 Mbit/s
+MEDIA_SIZE_BYTES = 1500 * 1024 * 1024
+SEGMENT_TYPES = ("Intro", "Recap", "Preview", "Commercial", "Outro")
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+# Keep alive interval the fake websocket asks for, in seconds
+WEBSOCKET_KEEP_ALIVE_SECONDS = 60
+
+
+def make_text_frame(text):
+    """Encode an unmasked websocket text frame, as sent by servers"""
+    payload = text.encode("utf-8")
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x81, length)
+    elif length < 65536:
+        header = struct.pack("!BBH", 0x81, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, length)
+    return header + payload
+
+
+def make_item_id(index):
+    return "%032x" % (0x5e6e0000000000000000000000000000 + index)
+
+
+def make_segments(item_id, count, duration_seconds=DURATION_SECONDS):
+    """Evenly spread segments of one minute over the duration, ending with the outro"""
+    segments = []
+    step = duration_seconds / max(count, 1)
+    for index in range(count):
+        start = index * step
+        segments.append({
+            "Id": "%s%08x" % (item_id[:24], index),
+            "ItemId": item_id,
+            "Type": SEGMENT_TYPES[-1] if index == count - 1 else SEGMENT_TYPES[index % (len(SEGMENT_TYPES) - 1)],
+            "StartTicks": int(start * TICKS_PER_SECOND),
+            "EndTicks": int(min(start + 60, duration_seconds) * TICKS_PER_SECOND),
+        })
+    return {"Items": segments, "TotalRecordCount": len(segments), "StartIndex": 0}
+
+
+class FakeJellyfin(object):
+    """
+    :param segments: amount of segments per item
+    :param latency: seconds every response is delayed
+    :param items: amount of episodes in the fake library, all in one series
+    """
+
+    def __init__(self, segments=10, latency=0.05, items=20):
+        self.segments = segments
+        self.latency = latency
+        self.item_ids = [make_item_id(index) for index in range(items)]
+        self.requests = Counter()
+        self.stream_bytes = 0
+        # Message queues of the open websocket connections
+        self._websockets = []
+        # Amount of websocket handshakes still to answer with 503
+        self._refused_websockets = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        # Clients giving up on slow responses close the connection, that is expected
+        self._server.handle_error = lambda request, client_address: None
+        self._thread = None
+
+    @property
+    def address(self):
+        return "http://127.0.0.1:%s" % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeJellyfin")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+
+    def websocket_count(self):
+        with self._lock:
+            return len(self._websockets)
+
+    def push_library_changed(self, updated=(), removed=()):
+        """Send a LibraryChanged message to all open websocket connections"""
+        message = {"MessageType": "LibraryChanged",
+                   "Data": {"ItemsUpdated": list(updated), "ItemsRemoved": list(removed)}}
+        with self._lock:
+            for messages in self._websockets:
+                messages.put(message)
+
+    def refuse_websockets(self, count):
+        """Answer the next websocket handshakes with 503, like a restarting server"""
+        with self._lock:
+            self._refused_websockets = count
+
+    def drop_websockets(self):
+        """Close all open websocket connections without a close frame, like a network drop"""
+        with self._lock:
+            for messages in self._websockets:
+                messages.put(None)
+
+    def serve_websocket(self, handler):
+        with self._lock:
+            refuse = self._refused_websockets > 0
+            self._refused_websockets -= 1 if refuse else 0
+        if refuse:
+            self.count("WebSocketRefused")
+            handler.send_response(503)
+            handler.send_header("Content-Length", "0")
+            handler.end_headers()
+            return
+
+        key = handler.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        handler.send_response(101, "Switching Protocols")
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.close_connection = True
+        self.count("WebSocket")
+
+        messages = queue.Queue()
+        messages.put({"MessageType": "ForceKeepAlive", "Data": WEBSOCKET_KEEP_ALIVE_SECONDS})
+        with self._lock:
+            self._websockets.append(messages)
+
+        try:
+            while True:
+                message = messages.get()
+                if message is None:
+                    return
+                handler.wfile.write(make_text_frame(json.dumps(message)))
+        finally:
+            with self._lock:
+                self._websockets.remove(messages)
+
+    def count_bytes(self, length):
+        with self._lock:
+            self.stream_bytes += length
+
+    def handle(self, path, query):
+        """
+        :return: tuple of (kind, payload) or None if the endpoint is unknown
+        """
+        match = re.match(r"^/MediaSegments/([0-9a-f]+)$", path)
+        if match:
+            return "MediaSegments", make_segments(match.group(1), self.segments)
+
+        match = re.match(r"^/Items/([0-9a-f]+)$", path)
+        if match:
+            return "Items", {"Id": match.group(1), "Type": "Episode", "SeriesId": "5e71e5",
+                             "RunTimeTicks": DURATION_SECONDS * TICKS_PER_SECOND,
+                             "MediaSources": [{"Id": match.group(1), "Size": MEDIA_SIZE_BYTES,
+                                               "Bitrate": MEDIA_SIZE_BYTES * 8 // DURATION_SECONDS}]}
+
+        if re.match(r"^/Shows/[0-9a-f]+/Episodes$", path):
+            start = query.get("StartItemId", [self.item_ids[0]])[0]
+            limit = int(query.get("Limit", ["1"])[0])
+            index = self.item_ids.index(start) if start in self.item_ids else 0
+            items = [{"Id": item_id, "Type": "Episode"} for item_id in self.item_ids[index:index + limit]]
+            return "Episodes", {"Items": items, "TotalRecordCount": len(items)}
+
+        if re.match(r"^/Users/[0-9a-f]+/Items$", path):
+            start = int(query.get("StartIndex", ["0"])[0])
+            limit = int(query.get("Limit", ["500"])[0])
+            items = [{"Id": item_id, "Type": "Episode", "Path": "/media/show/episode%s.mkv" % index}
+                     for index, item_id in enumerate(self.item_ids)][start:start + limit]
+            return "LibraryItems", {"Items": items, "TotalRecordCount": len(self.item_ids)}
+
+        return None
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def send_stream(self):
+                """Answer ranged requests of the media stream with zeros"""
+                match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+                start = int(match.group(1)) if match else 0
+                end = int(match.group(2)) if match and match.group(2) else MEDIA_SIZE_BYTES - 1
+                end = min(end, MEDIA_SIZE_BYTES - 1)
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+                fake.count("Stream")
+                fake.count_bytes(end - start + 1)
+
+                self.send_response(206 if match else 200)
+                self.send_header("Content-Type", "video/x-matroska")
+                self.send_header("Content-Range", "bytes %s-%s/%s" % (start, end, MEDIA_SIZE_BYTES))
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+
+                chunk = bytes(64 * 1024)
+                remaining = end - start + 1
+                while remaining > 0:
+                    self.wfile.write(chunk[:remaining])
+                    remaining -= len(chunk)
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                if re.match(r"^/Videos/[0-9a-f]+/stream$", parts.path):
+                    self.send_stream()
+                    return
+                if parts.path == "/socket":
+                    fake.serve_websocket(self)
+                    return
+
+                result = fake.handle(parts.path, parse_qs(parts.query))
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if result is None:
+                    fake.count("NotFound")
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                kind, payload = result
+                fake.count(kind)
+                body = json.dumps(payload).encode("utf-8")
+                etag = '"%08x"' % zlib.crc32(body)
+
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,323 @@
+"""
+Offline benchmarks of the Jellyskip service, run outside Kodi.
+
+Kodi's modules are replaced by the stubs in benchmarks/stubs and the Jellyfin server by a local fake server.
+Realistic event sequences (play, seeks, AV changes, pause, speed changes, skip clicks, stop) are replayed through
+JellySkipMonitor.onNotification, followed by a library sync, a websocket LibraryChanged burst with a reconnect, and micro benchmarks of
+get_next_item and the scheduler.
+
+Usage: python benchmarks/run_benchmarks.py [--segments 10] [--latency 0.05] [--seeks 200] [--iterations 5]
+                                           [--skips 3] [--seek-delay 0.2] [--prebuffer]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_PATH)
+sys.path.insert(0, os.path.join(BENCHMARK_PATH, "stubs"))
+sys.path.insert(0, os.path.join(BENCHMARK_PATH, "..", "resources", "lib"))
+
+import xbmc  # noqa: E402
+import xbmcaddon  # noqa: E402
+import xbmcgui  # noqa: E402
+import xbmcvfs  # noqa: E402
+
+from fake_jellyfin import DURATION_SECONDS, FakeJellyfin, make_segments  # noqa: E402
+
+# Longer than the default fetch budget of the service
+SEGMENT_WAIT_SECONDS = 10
+SERVER_ID = "5e7e5e7e5e7e5e7e5e7e5e7e5e7e5e7e"
+USER_ID = "05e705e705e705e705e705e705e705e7"
+
+
+def write_jellyfin_credentials(address):
+    path = xbmcvfs.translatePath("special://profile/addon_data/plugin.video.jellyfin/data.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"Servers": [{
+            "Id": SERVER_ID,
+            "Name": "Fake Jellyfin",
+            "address": address,
+            "AccessToken": "benchmark",
+            "UserId": USER_ID,
+        }]}, f)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def format_ms(values):
+    if not values:
+        return "n/a"
+    return "avg %.2f ms, p50 %.2f ms, p95 %.2f ms, max %.2f ms" % (
+        sum(values) / len(values) * 1000, percentile(values, 0.5) * 1000,
+        percentile(values, 0.95) * 1000, max(values) * 1000)
+
+
+class ThreadSampler(object):
+    """Samples the amount of running threads in the background"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="ThreadSampler")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            # Not counting the sampler itself
+            self.peak = max(self.peak, threading.active_count() - 1)
+
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.001)
+    return False
+
+
+def notify(monitor, method, data=None, sender="xbmc"):
+    start = time.perf_counter()
+    monitor.onNotification(sender, method, json.dumps(data or {}))
+    return time.perf_counter() - start
+
+
+def replay_skips(monitor, item_id, segment_count, skips, results):
+    """Seek to the start of segments and click the skip button once it shows"""
+    from skip_dialogue import OK_BUTTON
+
+    handler = monitor.get_dialogue_handler()
+    segments = make_segments(item_id, segment_count, DURATION_SECONDS)["Items"]
+
+    for segment in segments[:skips]:
+        start = segment["StartTicks"] / 10000000
+        xbmc.player_state.seek(max(start - 0.5, 0))
+        notify(monitor, "Player.OnSeek", {"player": {"playerid": 1}})
+
+        if not wait_for(handler.is_dialogue_visible, 5):
+            results["timeouts"] += 1
+            continue
+
+        # Give the prebuffer request time to finish, like a user reading the button
+        time.sleep(0.5)
+        xbmcgui.click(handler.dialogue, OK_BUTTON)
+        # Wait for the seek measurement
+        time.sleep(xbmc.player_state.seek_delay + 0.2)
+
+        # The click only seeks if the thread owning the window pumps its callbacks
+        results["skips"] += 1
+        if xbmc.player_state.time() < segment["EndTicks"] / 10000000:
+            results["missed_skips"] += 1
+
+
+def replay_playback(monitor, item_id, args, rng, results):
+    """Play one item, seek around, change audio/video streams, skip segments and stop"""
+    player_state = xbmc.player_state
+    jf_hack = monitor.get_jellyfin()
+
+    start = time.perf_counter()
+    player_state.play("plugin://plugin.video.jellyfin/?id=%s&mode=play" % item_id, DURATION_SECONDS)
+    results["notification"].append(notify(monitor, "Player.OnPlay", {"item": {"type": "episode"}}))
+
+    if wait_for(lambda: jf_hack.get_media_segments(fetch=False) is not None, SEGMENT_WAIT_SECONDS):
+        results["play_to_segments"].append(time.perf_counter() - start)
+    else:
+        results["timeouts"] += 1
+
+    for index in range(args.seeks):
+        player_state.seek(rng.uniform(0, DURATION_SECONDS))
+        method = "Player.OnAVChange" if index % 10 == 9 else "Player.OnSeek"
+        results["notification"].append(notify(monitor, method, {"player": {"playerid": 1}}))
+
+        if index % 25 == 24:
+            # Pause, resume and fast forward now and then
+            for method, speed in (("Player.OnPause", 0), ("Player.OnResume", 1),
+                                  ("Player.OnSpeedChanged", 2), ("Player.OnSpeedChanged", 1)):
+                player_state.set_speed(speed)
+                results["notification"].append(notify(monitor, method, {"player": {"playerid": 1, "speed": speed}}))
+        if args.seek_interval:
+            time.sleep(args.seek_interval)
+
+    replay_skips(monitor, item_id, args.segments, args.skips, results)
+
+    player_state.stop()
+    results["notification"].append(notify(monitor, "Player.OnStop", {"end": False}))
+
+
+def run_playback_benchmark(fake, args):
+    from monitor import JellySkipMonitor
+    from helper.metrics import metrics
+
+    monitor = JellySkipMonitor()
+    # The main loop of the monitor runs the window actions and pumps the window callbacks, like Kodi's service thread
+    main_loop = threading.Thread(target=monitor.start, name="JellySkipMain")
+    main_loop.start()
+    wait_for(lambda: monitor.sync_task is not None, 5)
+    # The library sync is benchmarked on its own
+    monitor.sync_task.cancel()
+    rng = random.Random(args.seed)
+    results = {"notification": [], "play_to_segments": [], "timeouts": 0, "skips": 0, "missed_skips": 0}
+
+    tracemalloc.start()
+    sampler = ThreadSampler().start()
+    started = time.perf_counter()
+
+    for iteration in range(args.iterations):
+        item_id = fake.item_ids[iteration % len(fake.item_ids)]
+        replay_playback(monitor, item_id, args, rng, results)
+
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Let background work (prefetching, dialogue timers) settle before counting requests
+    wait_for(lambda: threading.active_count() <= 3, 5)
+    xbmc.request_abort()
+    main_loop.join()
+    xbmc.reset_abort()
+
+    print("Playback replay: %s iterations, %s seeks each, %.2f s" % (args.iterations, args.seeks, elapsed))
+    print("  play to segments:     %s (timeouts: %s)" % (format_ms(results["play_to_segments"]), results["timeouts"]))
+    print("  onNotification:       %s" % format_ms(results["notification"]))
+    print("  server requests:      %s" % dict(sorted(fake.requests.items())))
+    print("  prebuffered:          %.1f MiB" % (fake.stream_bytes / 1024 / 1024))
+    print("  peak threads:         %s" % sampler.peak)
+    print("  dialogues:            %s built, %s shown" % (xbmcgui.dialogs_created, len(xbmcgui.dialogs_opened)))
+    print("  skip clicks:          %s, %s without seeking" % (results["skips"], results["missed_skips"]))
+    print("  memory:               current %.1f KiB, peak %.1f KiB" % (current / 1024, peak / 1024))
+    print("  metrics:              %s" % metrics.summary())
+
+
+def run_library_sync_benchmark(fake):
+    from jellyfin.jellyfin_grabber import JellyfinHack
+
+    fake.requests.clear()
+    jf_hack = JellyfinHack()
+    start = time.perf_counter()
+    jf_hack.sync_library()
+    print("Library sync: %s items in %.2f s, server requests: %s" % (
+        len(fake.item_ids), time.perf_counter() - start, dict(sorted(fake.requests.items()))))
+    return jf_hack
+
+
+def run_websocket_benchmark(fake, jf_hack, burst):
+    """Push a burst of library changes over the websocket, then drop the connection and refuse one reconnect"""
+    xbmcaddon.settings["websocket_invalidation"] = "true"
+    jf_hack.start_change_listener()
+    try:
+        if not wait_for(lambda: fake.websocket_count() == 1, 5):
+            print("Websocket: not connected")
+            return
+
+        # The cached library items are refreshed, the unknown ones only checked against the cache
+        fake.requests.clear()
+        unknown_item_ids = ["%032x" % (0x1000000000000000000000000000 + index) for index in range(burst)]
+        start = time.perf_counter()
+        fake.push_library_changed(updated=fake.item_ids + unknown_item_ids)
+        refreshed = wait_for(lambda: fake.requests["MediaSegments"] >= len(fake.item_ids), 10)
+        changed_seconds = time.perf_counter() - start
+
+        fake.refuse_websockets(1)
+        start = time.perf_counter()
+        fake.drop_websockets()
+        reconnected = wait_for(lambda: fake.websocket_count() == 1 and fake.requests["WebSocket"] > 0, 15)
+        reconnect_seconds = time.perf_counter() - start
+
+        print("Websocket: %s changed items handled in %.2f s%s, reconnected after a drop and a refusal in %.2f s%s" % (
+            len(fake.item_ids) + burst, changed_seconds, "" if refreshed else " (timeout)",
+            reconnect_seconds, "" if reconnected else " (timeout)"))
+        print("  server requests:      %s" % dict(sorted(fake.requests.items())))
+    finally:
+        jf_hack.stop_change_listener()
+
+
+def run_micro_benchmarks(args):
+    from jellyfin.media_segments import MediaSegmentResponse
+    from helper.scheduler import Scheduler
+
+    response = MediaSegmentResponse.from_json(make_segments("5e6e", args.segments, DURATION_SECONDS))
+    rng = random.Random(args.seed)
+    positions = [rng.uniform(0, DURATION_SECONDS) for _ in range(1000)]
+
+    def next_items():
+        for position in positions:
+            response.get_next_item(position)
+
+    seconds = min(timeit.repeat(next_items, number=10, repeat=5)) / (10 * len(positions))
+    print("get_next_item (%s segments): %.2f us per call" % (args.segments, seconds * 1000000))
+
+    scheduler = Scheduler()
+    scheduler.start()
+
+    def schedule_cancel():
+        tasks = [scheduler.schedule(60 + index, gc.collect) for index in range(1000)]
+        for task in tasks:
+            task.cancel()
+
+    seconds = min(timeit.repeat(schedule_cancel, number=1, repeat=5)) / 1000
+    print("scheduler schedule + cancel: %.2f us per task" % (seconds * 1000000))
+    scheduler.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--segments", type=int, default=10, help="media segments per item")
+    parser.add_argument("--latency", type=float, default=0.05, help="response latency of the fake server in seconds")
+    parser.add_argument("--seeks", type=int, default=200, help="seeks per playback")
+    parser.add_argument("--seek-interval", type=float, default=0, help="seconds between seeks")
+    parser.add_argument("--iterations", type=int, default=5, help="playbacks to replay")
+    parser.add_argument("--items", type=int, default=20, help="episodes in the fake library")
+    parser.add_argument("--skips", type=int, default=3, help="skip button clicks per playback")
+    parser.add_argument("--seek-delay", type=float, default=0, help="simulated rebuffering after a seek in seconds")
+    parser.add_argument("--prebuffer", action="store_true", help="read the stream at the skip target ahead of skipping")
+    parser.add_argument("--websocket-burst", type=int, default=5000,
+                        help="unknown items in the pushed LibraryChanged message")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log", action="store_true", help="print the service log")
+    args = parser.parse_args()
+
+    # Warnings only, the log handler would otherwise dominate the timings
+    xbmcaddon.settings.update({"logLevel": "2" if args.log else "0", "library_sync": "true",
+                               "prebuffer_skip_target": "true" if args.prebuffer else "false"})
+    xbmc.player_state.seek_delay = args.seek_delay
+    if args.log:
+        xbmc.log = lambda msg, level=0: print(msg)
+
+    fake = FakeJellyfin(segments=args.segments, latency=args.latency, items=args.items).start()
+    try:
+        write_jellyfin_credentials(fake.address)
+        run_playback_benchmark(fake, args)
+        jf_hack = run_library_sync_benchmark(fake)
+        run_websocket_benchmark(fake, jf_hack, args.websocket_burst)
+        run_micro_benchmarks(args)
+    finally:
+        fake.stop()
+        xbmc.request_abort()
+
+
+if __name__ == "__main__":
+    main()
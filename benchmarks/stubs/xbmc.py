@@ -0,0 +1,173 @@
+"""Minimal stand-in for Kodi's xbmc module, enough to run the service outside Kodi."""
+import threading
+import time
+
+LOGDEBUG = 0
+LOGINFO = 1
+LOGNOTICE = 1
+LOGWARNING = 2
+LOGERROR = 3
+
+log_lines = []
+builtins = []
+
+_abort = threading.Event()
+# Window callbacks waiting for their owner thread, Kodi runs them only while that thread waits in waitForAbort or sleep
+_callbacks = {}
+_callbacks_lock = threading.Lock()
+# Slice of a wait after which queued callbacks are run
+CALLBACK_POLL_SECONDS = 0.005
+
+
+def log(msg, level=LOGDEBUG):
+    log_lines.append(msg)
+
+
+def getInfoLabel(label):
+    return ""
+
+
+def executebuiltin(command, wait=False):
+    builtins.append(command)
+
+
+def translatePath(path):
+    import xbmcvfs
+    return xbmcvfs.translatePath(path)
+
+
+def request_abort():
+    _abort.set()
+
+
+def reset_abort():
+    _abort.clear()
+
+
+def queue_callback(thread_id, target, *args):
+    """Queue a callback for the thread with the given ident"""
+    with _callbacks_lock:
+        _callbacks.setdefault(thread_id, []).append((target, args))
+
+
+def pending_callbacks(thread_id=None):
+    with _callbacks_lock:
+        return len(_callbacks.get(thread_id or threading.get_ident(), []))
+
+
+def _run_callbacks():
+    with _callbacks_lock:
+        callbacks = _callbacks.pop(threading.get_ident(), [])
+    for target, args in callbacks:
+        target(*args)
+
+
+def _pump(timeout=None, event=None):
+    """Run the callbacks of the current thread until the timeout passes or the event is set"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        _run_callbacks()
+        if event is not None and event.is_set():
+            return True
+        remaining = CALLBACK_POLL_SECONDS if deadline is None else min(deadline - time.monotonic(),
+                                                                       CALLBACK_POLL_SECONDS)
+        if remaining <= 0:
+            return False
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(remaining)
+
+
+def sleep(milliseconds):
+    _pump(milliseconds / 1000)
+
+
+class Monitor(object):
+
+    def __init__(self):
+        pass
+
+    def abortRequested(self):
+        return _abort.is_set()
+
+    def waitForAbort(self, timeout=None):
+        return _pump(timeout, _abort)
+
+
+class PlayerState(object):
+    """Simulated playback clock shared by all Player instances"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.total_time = 0.0
+        self.position = 0.0
+        self.started_at = None
+        self.speed = 1.0
+        # Simulated rebuffering, the position stands still for this long after a seek
+        self.seek_delay = 0.0
+
+    def play(self, file, total_time, position=0.0):
+        with self.lock:
+            self.file = file
+            self.total_time = total_time
+            self.position = position
+            self.started_at = time.monotonic()
+            self.speed = 1.0
+
+    def stop(self):
+        with self.lock:
+            self.file = None
+
+    def seek(self, seconds):
+        with self.lock:
+            self.position = seconds
+            self.started_at = time.monotonic() + self.seek_delay
+
+    def set_speed(self, speed):
+        with self.lock:
+            self.position = self._time()
+            self.started_at = time.monotonic()
+            self.speed = speed
+
+    def _time(self):
+        return min(self.position + max(time.monotonic() - self.started_at, 0) * self.speed, self.total_time)
+
+    def time(self):
+        with self.lock:
+            if self.file is None:
+                raise RuntimeError("Kodi is not playing any media file")
+            return self._time()
+
+
+player_state = PlayerState()
+
+
+class Player(object):
+
+    def __init__(self):
+        pass
+
+    def isPlaying(self):
+        return player_state.file is not None
+
+    def isPlayingVideo(self):
+        return player_state.file is not None
+
+    def getPlayingFile(self):
+        if player_state.file is None:
+            raise RuntimeError("Kodi is not playing any media file")
+        return player_state.file
+
+    def getTime(self):
+        return player_state.time()
+
+    def getTotalTime(self):
+        return player_state.total_time
+
+    def seekTime(self, seconds):
+        player_state.seek(seconds)
+
+    def pause(self):
+        player_state.set_speed(0.0 if player_state.speed else 1.0)
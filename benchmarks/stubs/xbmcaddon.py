@@ -0,0 +1,26 @@
+"""Minimal stand-in for Kodi's xbmcaddon module. Settings live in a shared dict."""
+import os
+
+ADDON_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".."))
+
+settings = {}
+
+
+class Addon(object):
+
+    def __init__(self, id=None):
+        self.id = id or "service.jellyskip"
+
+    def getAddonInfo(self, key):
+        return {
+            "path": ADDON_PATH,
+            "name": "Jellyskip",
+            "id": self.id,
+            "icon": os.path.join(ADDON_PATH, "icon.png"),
+        }.get(key, "")
+
+    def getSetting(self, key):
+        return settings.get(key, "")
+
+    def setSetting(self, key, value):
+        settings[key] = value
@@ -0,0 +1,110 @@
+"""Minimal stand-in for Kodi's xbmcgui module."""
+import threading
+
+import xbmc
+
+ACTION_PREVIOUS_MENU = 10
+ACTION_NAV_BACK = 92
+ACTION_STOP = 13
+
+_properties = {}
+notifications = []
+dialogs_opened = []
+dialogs_created = 0
+
+
+class Window(object):
+
+    def __init__(self, window_id=-1):
+        self.window_id = window_id
+
+    def getProperty(self, key):
+        return _properties.get((self.window_id, key.lower()), "")
+
+    def setProperty(self, key, value):
+        _properties[(self.window_id, key.lower())] = value
+
+    def clearProperty(self, key):
+        _properties.pop((self.window_id, key.lower()), None)
+
+
+class Control(object):
+
+    def __init__(self):
+        self.label = ""
+        self.visible = True
+
+    def setLabel(self, label):
+        self.label = label
+
+    def setVisible(self, visible):
+        self.visible = visible
+
+
+class WindowXMLDialog(Window):
+    """
+    Records openings instead of rendering. doModal blocks until close() like in Kodi.
+    Like in Kodi, the callbacks (onInit, onClick, onAction) run on the thread that created the window, and only
+    while it waits in xbmc.Monitor.waitForAbort, xbmc.sleep or doModal. Use click and send_action to deliver input.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        global dialogs_created
+        dialogs_created += 1
+        window = super(WindowXMLDialog, cls).__new__(cls)
+        window._stub_owner = threading.get_ident()
+        return window
+
+    def _controls(self):
+        if not hasattr(self, "_stub_controls"):
+            self._stub_controls = {}
+            self._stub_closed = threading.Event()
+        return self._stub_controls
+
+    def _queue_callback(self, target, *args):
+        xbmc.queue_callback(self._stub_owner, target, *args)
+
+    def getControl(self, control_id):
+        return self._controls().setdefault(control_id, Control())
+
+    def setFocusId(self, control_id):
+        pass
+
+    def show(self):
+        self._controls()
+        self._stub_closed.clear()
+        dialogs_opened.append(self)
+        self._queue_callback(self.onInit)
+
+    def doModal(self):
+        self.show()
+        xbmc._pump(event=self._stub_closed)
+
+    def close(self):
+        self._controls()
+        self._stub_closed.set()
+
+    def onInit(self):
+        pass
+
+
+def click(window, control_id):
+    """Click a control of the window, the click is handled by the thread owning the window"""
+    window._queue_callback(window.onClick, control_id)
+
+
+def send_action(window, action):
+    """Send an action (e.g. ACTION_NAV_BACK) to the window, handled by the thread owning the window"""
+    window._queue_callback(window.onAction, action)
+
+
+class Dialog(object):
+
+    def notification(self, heading, message, icon="", time=5000, sound=True):
+        notifications.append((heading, message))
+
+    def ok(self, heading, message):
+        return True
+
+    def textviewer(self, heading, text):
+        pass
@@ -0,0 +1,11 @@
+"""Minimal stand-in for Kodi's xbmcvfs module. special://profile points to a temporary directory."""
+import os
+import tempfile
+
+profile_path = tempfile.mkdtemp(prefix="jellyskip-bench-")
+
+
+def translatePath(path):
+    if path.startswith("special://profile/"):
+        return os.path.join(profile_path, path[len("special://profile/"):])
+    return path
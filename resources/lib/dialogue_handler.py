@@ -1,31 +1,191 @@
-import xbmc, xbmcaddon
+import time
+from enum import Enum
+
+import xbmc, xbmcaddon, xbmcgui
 import helper.utils as utils
 
-from skip_dialogue import SkipSegmentDialogue
-from jellyfin.jellyfin_grabber import JellyfinHack
-from skip_dialogue import SkipSegmentDialogue
+from skip_dialogue import SkipSegmentDialogue, get_seek_target, seek_past_segment
 from helper import LazyLogger
+from helper.metrics import metrics
 
-from jellyfin.media_segments import MediaSegmentItem
+from jellyfin.media_segments import MediaSegmentItem, MediaSegmentResponse, SegmentType, DEFAULT_MERGE_GAP_SECONDS
 
 addonInfo = xbmcaddon.Addon().getAddonInfo
 addonPath = utils.translate_path(addonInfo('path'))
 
 LOG = LazyLogger(__name__)
 
-SECOND_PADDING = 1
+# Default delay between segment start and showing the dialogue, overridden by the dialogue_padding setting
+DEFAULT_PADDING_SECONDS = 0.2
+# Tolerated difference between the scheduler clock and the player time when a scheduled dialogue fires
+SCHEDULE_TOLERANCE_SECONDS = 0.25
+
+
+# Default time after an automatic skip in which seeking back into the segment cancels the skip
+DEFAULT_UNDO_WINDOW_SECONDS = 10
+# Seeking back further than this before the segment end counts as undoing an automatic skip
+UNDO_MARGIN_SECONDS = 2
+# Playback time before an armed segment from which its dialogue is expected to open
+WINDOW_LEAD_SECONDS = 2
+# Playback time before an automatically skipped segment at which its skip target is prebuffered
+PREBUFFER_LEAD_SECONDS = 10
+
+
+class SegmentAction(Enum):
+    ASK = 0
+    AUTO_SKIP = 1
+    IGNORE = 2
+
+
+def get_padding_seconds():
+    return utils.settings_number('dialogue_padding', DEFAULT_PADDING_SECONDS)
+
+
+def get_segment_action(segment_type: SegmentType):
+    """
+    Get the configured action for the segment type, defaults to asking the user
+    :param segment_type: the segment type
+    :return: SegmentAction
+    """
+    try:
+        return SegmentAction(utils.settings_number(f'action_{segment_type.value.lower()}', SegmentAction.ASK.value,
+                                                  cached=True))
+    except ValueError:
+        return SegmentAction.ASK
+
+
+def get_merge_key(segment_type: SegmentType):
+    """
+    Segments are only merged into one skip range with segments handled the same way, ignored segments never
+    :param segment_type: the segment type
+    :return: SegmentAction or None
+    """
+    action = get_segment_action(segment_type)
+    return None if action == SegmentAction.IGNORE else action
 
 
 class DialogueHandler:
 
     def __init__(self):
         self.dialogue = None
-        self.scheduled_thread = None
+        self.scheduled_task = None
+        # Upcoming segment item, handled when the playback clock enters it
+        self.armed_item = None
         self.last_item = None
+        self.scheduler = None
+        self.clock = None
+        # Callable receiving a position in seconds, reads the stream there ahead of a skip
+        self.prebuffer = None
+        self.prebuffered_target = None
+        self.prebuffer_task = None
+        # Callable running window actions on the thread owning the dialogue, see set_ui_runner
+        self.ui_runner = None
+        # Automatically skipped items mapped to the time of the skip, and items the user went back to
+        self.auto_skipped = {}
+        self.undone_items = set()
+
+    def set_scheduler(self, scheduler):
+        """
+        Set the scheduler used for delayed dialogue actions, owned by the monitor
+        :param scheduler: the helper.scheduler.Scheduler instance
+        :return: None
+        """
+        self.scheduler = scheduler
+
+    def set_clock(self, clock):
+        """
+        Set the playback clock used to read the position, owned by the monitor
+        :param clock: the PlaybackClock instance
+        :return: None
+        """
+        self.clock = clock
+
+    def set_ui_runner(self, ui_runner):
+        """
+        Set the callable running window actions on the thread that owns the dialogue and pumps its callbacks
+        :param ui_runner: callable receiving a target and its arguments, owned by the monitor
+        :return: None
+        """
+        self.ui_runner = ui_runner
+
+    def _run_ui(self, target, *args):
+        if self.ui_runner is None:
+            target(*args)
+        else:
+            self.ui_runner(target, *args)
+
+    def set_prebuffer(self, prebuffer):
+        """
+        Set the callable warming up the stream at a skip target, owned by the monitor
+        :param prebuffer: callable receiving the skip target in seconds
+        :return: None
+        """
+        self.prebuffer = prebuffer
+
+    def prebuffer_skip_target(self, item: MediaSegmentItem):
+        """
+        Read the stream at the end of the segment ahead of the skip, if enabled in the settings
+        :param item: the segment item that may be skipped
+        :return: None
+        """
+        if self.prebuffer is None or utils.settings('prebuffer_skip_target.bool') is not True:
+            return
+
+        try:
+            target_seconds = get_seek_target(self.clock.player.getTotalTime(), item.get_end_seconds())
+        except Exception as error:
+            LOG.debug("Could not get the skip target of %s: %s", item.get_segment_type_display(), error)
+            return
+
+        if target_seconds != self.prebuffered_target:
+            self.prebuffered_target = target_seconds
+            self.prebuffer(target_seconds)
+
+    def schedule_prebuffer(self, item: MediaSegmentItem, current_seconds):
+        """
+        Prebuffer the skip target of an automatically skipped segment shortly before the segment starts
+        :param item: the armed segment item
+        :param current_seconds: the current playback time in seconds
+        :return: None
+        """
+        if self.prebuffer is None:
+            return
+
+        speed = self.clock.get_speed()
+        delay = item.get_start_seconds() - PREBUFFER_LEAD_SECONDS - current_seconds
+        delay = delay / speed if speed > 0 else delay
+        self.prebuffer_task = self.scheduler.schedule(delay, self.prebuffer_skip_target, args=(item,))
+
+    def skip_to(self, seek_time_seconds):
+        """
+        Seek past a segment and measure how long the player takes to play again
+        :param seek_time_seconds: the segment end in seconds
+        :return: None
+        """
+        target_seconds = seek_past_segment(self.clock.player, seek_time_seconds)
+        prebuffered = target_seconds == self.prebuffered_target
+        self.clock.measure_seek(target_seconds, "seek_to_playback_prebuffered" if prebuffered else "seek_to_playback")
+
+    @staticmethod
+    def get_skip_ranges(media_segments: MediaSegmentResponse):
+        """
+        Get the segments to handle. Ignored segment types are left out, so they never hide the segments after them,
+        and overlapping and near-adjacent segments are merged into skip ranges, if enabled in the settings.
+        :param media_segments: the media segments of the playing item
+        :return: MediaSegmentResponse
+        """
+        media_segments = media_segments.exclude(segment_type for segment_type in SegmentType
+                                                if get_segment_action(segment_type) == SegmentAction.IGNORE)
+
+        if utils.cached_settings('merge_segments.bool') is False:
+            return media_segments
+
+        return media_segments.normalize(utils.settings_number('merge_gap', DEFAULT_MERGE_GAP_SECONDS, cached=True),
+                                        merge_key=get_merge_key)
 
     def schedule_skip_gui(self, item: MediaSegmentItem, current_seconds):
         """
-        Schedule the dialogue to open at the start of the upcoming segment.
+        Arm the upcoming segment, its dialogue opens (or it is skipped) when the playback clock enters it.
         If the segment has already started, opens the dialogue immediately.
 
         :param item: the segment item to schedule
@@ -36,67 +196,219 @@ class DialogueHandler:
         if not item:
             return
 
-        # Cancel any existing scheduled thread
+        # Disarm any previously scheduled item
         self.cancel_scheduled()
 
-        if self.last_item and not self.is_last_item_segment() and self.dialogue:
-            # The last segment item is not currently playing, but our dialogue is still open possibly due to a seek
-            LOG.info(f"Closing dialogue for {self.last_item.get_segment_type_display()} at {self.last_item.get_start_seconds()} as it is not currently playing")
-            self.dialogue.close()
-            self.dialogue = None
+        if self.last_item and not self.is_last_item_segment():
+            # The last segment item is not currently playing, but our dialogue may still be open due to a seek
+            LOG.debug("Closing dialogue for %s at %s as it is not currently playing",
+                      self.last_item.get_segment_type_display(), self.last_item.get_start_seconds())
+            self.close_gui()
 
         if item.get_end_seconds() < current_seconds:
             # We are past the segment, no need to schedule
             return
 
-        if item.get_start_seconds() < current_seconds:
-            self.open_gui(item)
+        action = get_segment_action(item.segment_type)
+
+        if action == SegmentAction.IGNORE:
+            LOG.info("Ignoring %s at %.3f", item.get_segment_type_display(), item.get_start_seconds())
+            return
+
+        if action == SegmentAction.AUTO_SKIP:
+            if item.get_start_seconds() <= current_seconds:
+                self.auto_skip(item, current_seconds)
+                return
+            self.schedule_prebuffer(item, current_seconds)
         else:
-            seconds_till_start = item.get_start_seconds() - current_seconds
-            self.scheduled_thread = utils.run_threaded(self.on_gui_scheduled, delay=seconds_till_start + SECOND_PADDING,
-                                                       kwargs={'item': item})
-            LOG.info(
-                f"Scheduled dialogue for {item.get_segment_type_display()} at {item.get_start_seconds()} in {seconds_till_start} seconds")
+            # Build the window ahead of the segment start, so showing it is quick
+            self._run_ui(self.get_dialogue)
+
+            if item.get_start_seconds() < current_seconds:
+                self.open_gui(item)
+                return
+
+        self.armed_item = item
+        LOG.debug("Armed %s at %.3f in %.3f seconds",
+                  item.get_segment_type_display(), item.get_start_seconds(), item.get_start_seconds() - current_seconds)
+
+    def on_segment_enter(self, item: MediaSegmentItem, position):
+        """
+        Open the dialogue for, or skip, the armed segment item. This is called by the playback clock.
+        :param item: the segment item entered
+        :param position: the playback position in seconds
+        :return: None
+        """
+
+        if item != self.armed_item:
+            return
+
+        self.armed_item = None
+        # How far past the segment start the clock noticed it
+        metrics.record("segment_enter_drift", position - item.get_start_seconds())
+
+        if get_segment_action(item.segment_type) == SegmentAction.AUTO_SKIP:
+            self.auto_skip(item, position)
+            return
+
+        # The padding is playback time, it passes faster when fast forwarding
+        speed = self.clock.get_speed()
+        delay = get_padding_seconds() / speed if speed > 0 else get_padding_seconds()
+        self.scheduled_task = self.scheduler.schedule(delay, self.on_gui_scheduled,
+                                                      kwargs={'item': item, 'planned_at': time.monotonic() + delay})
 
-    def on_gui_scheduled(self, item: MediaSegmentItem):
+    def on_segment_exit(self, item: MediaSegmentItem, position):
         """
-        Open the dialogue for the scheduled segment item. This is called by the scheduled thread.
+        Close the dialogue when playback leaves its segment and track the next segment. This is called by the
+        playback clock. The next segment is also tracked if the user already dismissed the dialogue.
+        :param item: the segment item left
+        :param position: the playback position in seconds
+        :return: None
+        """
+
+        if item != self.last_item:
+            return
+
+        if self.is_dialogue_visible():
+            LOG.info("JellySkip: Auto closing dialogue")
+        # Also closes a dialogue whose show is still queued for the main thread
+        self.close_gui()
+
+        sender = "service.jellyskip"
+        xbmc.executebuiltin("NotifyAll(%s, %s, %s)" % (sender, "Jellyskip.DialogueClosed", {}))
+
+    def on_gui_scheduled(self, item: MediaSegmentItem, planned_at=None):
+        """
+        Open the dialogue for the entered segment item once the padding passed. This is called by the scheduler.
         :param item: the segment item to open the dialogue for
+        :param planned_at: the monotonic time the dialogue was planned to open at
         :return: None
         """
 
-        player = xbmc.Player()
-        current_seconds = player.getTime()
+        current_seconds = self.clock.get_time()
 
-        LOG.info(
-            f"Opening scheduled dialogue for {item.get_segment_type_display()} at {item.get_start_seconds()} as within segment")
+        if planned_at is not None:
+            # How late the scheduler fired, and how far the player position is off the planned position
+            metrics.record("schedule_drift", time.monotonic() - planned_at)
+            planned_seconds = item.get_start_seconds() + get_padding_seconds()
+            metrics.record("dialogue_position_drift", current_seconds - planned_seconds)
 
-        if item.get_start_seconds() <= current_seconds <= item.get_end_seconds() - SECOND_PADDING:
+        LOG.debug("Opening scheduled dialogue for %s at %s as within segment",
+                  item.get_segment_type_display(), item.get_start_seconds())
+
+        start_seconds = item.get_start_seconds() - SCHEDULE_TOLERANCE_SECONDS
+        if start_seconds <= current_seconds <= item.get_end_seconds() - get_padding_seconds():
             self.open_gui(item)
             return
 
         # We are not within the segment
-        LOG.info(f"Skipping dialogue for {item.get_segment_type_display()} at {item.get_start_seconds()} as not within segment")
+        LOG.debug("Skipping dialogue for %s at %s as not within segment",
+                  item.get_segment_type_display(), item.get_start_seconds())
+
+    def auto_skip(self, item: MediaSegmentItem, current_seconds=None):
+        """
+        Seek past the segment and show a notification. If the user seeks back into an automatically skipped segment
+        within the undo window, the skip is undone and the segment is not skipped again during this playback.
+
+        :param item: the segment item to skip
+        :param current_seconds: the current playback time in seconds, read from the player if not given
+        :return: None
+        """
+
+        if item in self.undone_items:
+            return
+
+        if current_seconds is None:
+            current_seconds = self.clock.get_time()
+
+        skipped_at = self.auto_skipped.get(item)
+        undo_window = utils.settings_number('auto_skip_undo_window', DEFAULT_UNDO_WINDOW_SECONDS, cached=True)
+
+        if skipped_at is not None and time.monotonic() - skipped_at < undo_window:
+            # Either the seek landed slightly before the segment end, or the user went back to watch the segment
+            if current_seconds < item.get_end_seconds() - UNDO_MARGIN_SECONDS:
+                LOG.info("Automatic skip of %s undone by the user", item.get_segment_type_display())
+                self.undone_items.add(item)
+            return
+
+        LOG.info("Automatically skipping %s at %.3f", item.get_segment_type_display(), item.get_start_seconds())
+        self.auto_skipped[item] = time.monotonic()
+        self.close_gui()
+        self.skip_to(item.get_end_seconds())
+
+        if utils.cached_settings('auto_skip_notification.bool') is not False:
+            xbmcgui.Dialog().notification(
+                addonInfo('name'), f"Skipped {item.get_segment_type_display()}, seek back to undo",
+                addonInfo('icon'), int(max(undo_window, 1) * 1000), False
+            )
+
+    def reset_session(self):
+        """
+        Forget the automatic skips and release the dialogue of the previous playback
+        :return: None
+        """
+        self.auto_skipped.clear()
+        self.undone_items.clear()
+        self.prebuffered_target = None
+        self._run_ui(self._release_dialogue)
 
     def cancel_scheduled(self):
         """
-        Cancel the scheduled dialogue thread if it is running
+        Disarm the upcoming segment item and cancel the scheduled dialogue and prebuffer tasks if they are pending
         :return: None
         """
 
-        if self.scheduled_thread:
-            self.scheduled_thread.cancel()
-            self.scheduled_thread = None
-            LOG.info("Cancelled existing scheduled dialogue")
+        self.armed_item = None
+        if self.prebuffer_task:
+            self.prebuffer_task.cancel()
+            self.prebuffer_task = None
+        if self.scheduled_task:
+            self.scheduled_task.cancel()
+            self.scheduled_task = None
+            LOG.debug("Cancelled existing scheduled dialogue")
+
+    def get_dialogue(self):
+        """
+        Get the dialogue of this playback session, building the window on first use.
+        Only call this on the thread running the window actions.
+        :return: SkipSegmentDialogue
+        """
+        if self.dialogue is None:
+            with metrics.timer("dialogue_build"):
+                self.dialogue = SkipSegmentDialogue('script-dialog.xml', addonPath, player=self.clock.player,
+                                                    on_skip=self.skip_to)
+        return self.dialogue
+
+    def is_dialogue_visible(self):
+        return self.dialogue is not None and self.dialogue.visible
+
+    def expects_window_actions(self):
+        """
+        Check whether the dialogue is shown, or about to be shown for the armed segment
+        :return: bool
+        """
+        if self.is_dialogue_visible() or (self.scheduled_task is not None and self.scheduled_task.is_pending()):
+            return True
+
+        item = self.armed_item
+        return item is not None and get_segment_action(item.segment_type) == SegmentAction.ASK and \
+            item.get_start_seconds() - self.clock.get_time() < WINDOW_LEAD_SECONDS
 
     def close_gui(self):
         """
-        Close the dialogue if it is open / stored
+        Close the dialogue if it is shown. The window is kept to be shown again for the next segment.
         :return: None
         """
-        if self.dialogue:
+        # Queued even if not visible yet, a queued show_segment may still be ahead of it
+        self._run_ui(self._close_dialogue)
+
+    def _close_dialogue(self):
+        if self.is_dialogue_visible():
             self.dialogue.close()
-            self.dialogue = None
+
+    def _release_dialogue(self):
+        self._close_dialogue()
+        self.dialogue = None
 
     def is_last_item(self, item: MediaSegmentItem):
         """
@@ -115,12 +427,10 @@ class DialogueHandler:
         :return: bool - True if the last segment item is currently playing (player within the segment duration)
         """
 
-        player = xbmc.Player()
-
         if not self.last_item:
             return False
 
-        current_seconds = player.getTime()
+        current_seconds = self.clock.get_time()
         return self.last_item.get_start_seconds() <= current_seconds <= self.last_item.get_end_seconds()
 
     def open_gui(self, item: MediaSegmentItem):
@@ -133,17 +443,20 @@ class DialogueHandler:
         """
 
         if self.is_last_item(item):
-            LOG.info(f"Skipping dialogue for {item.get_segment_type_display()} at {item.get_start_seconds()} as it is the same as the last item")
+            LOG.debug("Skipping dialogue for %s at %s as it is the same as the last item",
+                      item.get_segment_type_display(), item.get_start_seconds())
             return
 
         self.last_item = item
-        LOG.info(f"Opening dialogue for {item.get_segment_type_display()} at {item.get_start_seconds()}")
-        self.close_gui()
-        dialog = SkipSegmentDialogue('script-dialog.xml', addonPath, seek_time_seconds=item.get_end_seconds(),
-                                     segment_type=item.get_segment_type_display())
-        self.dialogue = dialog
-        dialog.doModal()
-        del dialog
+        LOG.info("Opening dialogue for %s at %s", item.get_segment_type_display(), item.get_start_seconds())
+        self._run_ui(self._show_dialogue, item, time.monotonic())
+        self.prebuffer_skip_target(item)
+
+    def _show_dialogue(self, item: MediaSegmentItem, queued_at):
+        # How long the window action waited for the main thread
+        metrics.record("dialogue_queue", time.monotonic() - queued_at)
+        with metrics.timer("dialogue_show"):
+            self.get_dialogue().show_segment(item.get_end_seconds(), item.get_segment_type_display())
 
 
 dialogue_handler = DialogueHandler()
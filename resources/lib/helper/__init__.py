@@ -2,7 +2,9 @@ from .lazylogger import LazyLogger
 from .utils import addon_id
 from .utils import window
 from .utils import settings
+from .utils import settings_number
 from .utils import kodi_version
 from .utils import find
 from .utils import create_id
 from .utils import translate_path
+from .utils import profile_path
@@ -14,13 +14,41 @@ from . import utils
 
 ##################################################################################################
 
-__addon__ = xbmcaddon.Addon(id=utils.addon_id())
-__pluginpath__ = utils.translate_path(__addon__.getAddonInfo("path"))
+__pluginpath__ = None
+
+
+def _get_plugin_path():
+    # Resolved on first use, so importing the logger does not create an Addon instance
+    global __pluginpath__
+
+    if __pluginpath__ is None:
+        __pluginpath__ = utils.translate_path(xbmcaddon.Addon(id=utils.addon_id()).getAddonInfo("path"))
+
+    return __pluginpath__
 
 
 ##################################################################################################
 
 
+# Values of the logLevel setting
+LOG_LEVELS = {
+    0: logging.WARNING,
+    1: logging.INFO,
+    2: logging.DEBUG,
+}
+DEFAULT_LOG_LEVEL = 1
+
+
+def refresh_log_level():
+    """Read the logLevel setting and apply it to the add-on logger, called again when the settings change."""
+    try:
+        log_level = int(settings("logLevel"))
+    except (TypeError, ValueError):
+        log_level = DEFAULT_LOG_LEVEL
+
+    __LOGGER.setLevel(LOG_LEVELS.get(log_level, LOG_LEVELS[DEFAULT_LOG_LEVEL]))
+
+
 def getLogger(name=None):
     if name is None:
         return __LOGGER
@@ -39,29 +67,24 @@ class LogHandler(logging.StreamHandler):
         else:
             self.level = xbmc.LOGNOTICE
 
-    def emit(self, record):
-
-        if self._get_log_level(record.levelno):
-            string = self.format(record)
+        self._log_level_read = False
 
-            xbmc.log(string, level=self.level)
+    def filter(self, record):
+        if not self._log_level_read:
+            # The logLevel setting is read with the first record instead of at import, as reading it creates an
+            # Addon instance. Until then the logger lets all records through.
+            self._log_level_read = True
+            refresh_log_level()
+            if not getLogger().isEnabledFor(record.levelno):
+                return False
 
-    @classmethod
-    def _get_log_level(cls, level):
+        return logging.StreamHandler.filter(self, record)
 
-        levels = {
-            logging.ERROR: 0,
-            logging.WARNING: 0,
-            logging.INFO: 1,
-            logging.DEBUG: 2,
-        }
-        try:
-            # log_level = int(settings("logLevel"))
-            log_level = 2
-        except ValueError:
-            log_level = 2  # If getting settings fail, we probably want debug logging.
+    def emit(self, record):
+        # Records below the configured level are already dropped by the logger, before any formatting
+        string = self.format(record)
 
-        return log_level >= levels[level]
+        xbmc.log(string, level=self.level)
 
 class MyFormatter(logging.Formatter):
 
@@ -79,7 +102,7 @@ class MyFormatter(logging.Formatter):
         return result
 
     def formatException(self, exc_info):
-        _pluginpath_real = os.path.realpath(__pluginpath__)
+        _pluginpath_real = os.path.realpath(_get_plugin_path())
         res = []
 
         for o in traceback.format_exception(*exc_info):
@@ -96,7 +119,7 @@ class MyFormatter(logging.Formatter):
 
     def _gen_rel_path(self, record):
         if record.pathname:
-            record.relpath = os.path.relpath(record.pathname, __pluginpath__)
+            record.relpath = os.path.relpath(record.pathname, _get_plugin_path())
 
 
 __LOGGER = logging.getLogger("JELLYSKIP")
@@ -104,4 +127,5 @@ for handler in __LOGGER.handlers:
     __LOGGER.removeHandler(handler)
 
 __LOGGER.addHandler(LogHandler())
+# Lowered to the logLevel setting by the handler on the first record
 __LOGGER.setLevel(logging.DEBUG)
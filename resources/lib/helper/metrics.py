@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+#################################################################################################
+
+import threading
+import time
+from contextlib import contextmanager
+
+from . import LazyLogger
+from . import utils
+
+#################################################################################################
+
+LOG = LazyLogger(__name__)
+
+# Window property the metrics are published to, read by the addon.py script entry point
+WINDOW_PROPERTY = "jellyskip.metrics.json"
+
+
+#################################################################################################
+
+
+class TimingStats(object):
+    """Aggregated durations of one measured stage, in seconds"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 1) if self.count else None,
+            "min_ms": round(self.min * 1000, 1) if self.min is not None else None,
+            "max_ms": round(self.max * 1000, 1) if self.max is not None else None,
+            "last_ms": round(self.last * 1000, 1) if self.last is not None else None,
+        }
+
+
+class Metrics(object):
+    """Thread safe counters and stage timings, measured with the monotonic clock"""
+
+    def __init__(self):
+        self._counters = {}
+        self._timings = {}
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def record(self, name, seconds):
+        with self._lock:
+            stats = self._timings.get(name)
+            if stats is None:
+                stats = self._timings[name] = TimingStats()
+            stats.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Measure the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "uptime_s": round(time.monotonic() - self._started),
+                "threads": threading.active_count(),
+                "counters": dict(self._counters),
+                "timings": {name: stats.to_dict() for name, stats in self._timings.items()},
+            }
+
+    def summary(self):
+        """One line summary of all counters and average timings"""
+        snapshot = self.snapshot()
+        parts = ["threads=%s" % snapshot["threads"]]
+        parts.extend("%s=%s" % item for item in sorted(snapshot["counters"].items()))
+        parts.extend("%s=%sms/%s" % (name, stats["avg_ms"], stats["count"])
+                     for name, stats in sorted(snapshot["timings"].items()))
+        return " ".join(parts)
+
+    def publish(self):
+        """Log the summary and publish the snapshot as window property"""
+        LOG.info("Metrics: %s", self.summary())
+        utils.window(WINDOW_PROPERTY, self.snapshot())
+
+
+metrics = Metrics()
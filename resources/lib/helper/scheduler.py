@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+from __future__ import division, absolute_import, print_function, unicode_literals
+
+#################################################################################################
+
+import heapq
+import itertools
+import threading
+import time
+
+from . import LazyLogger
+from . import utils
+
+#################################################################################################
+
+LOG = LazyLogger(__name__)
+
+
+#################################################################################################
+
+
+class ScheduledTask(object):
+    """Handle of a task scheduled on a `Scheduler`, can be cancelled or rescheduled"""
+
+    def __init__(self, scheduler, target, args, kwargs, run_in_thread):
+        self.scheduler = scheduler
+        self.target = target
+        self.args = args
+        self.kwargs = kwargs
+        self.run_in_thread = run_in_thread
+        self.when = None
+        self.sequence = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        self.scheduler.reschedule(self, delay)
+
+    def is_pending(self):
+        return not self.cancelled and self.sequence is not None
+
+
+class Scheduler(object):
+    """Runs delayed tasks from a single long-lived thread, backed by a heap ordered by due time.
+
+    Tasks run on the scheduler thread and should return quickly. Tasks that block (e.g. a modal dialogue)
+    must be scheduled with `run_in_thread=True`.
+    """
+
+    def __init__(self):
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(target=self._run, name="JellySkipScheduler")
+            # Daemon threads may not work in Kodi, but enable it anyway
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Drop all pending tasks and stop the scheduler thread"""
+        with self._condition:
+            self._stopped = True
+            for _, _, task in self._queue:
+                task.cancelled = True
+                task.sequence = None
+            self._queue = []
+            self._condition.notify_all()
+            thread = self._thread
+            self._thread = None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def schedule(self, delay, target, args=None, kwargs=None, run_in_thread=False):
+        """
+        Schedule the target to run after the delay
+        :param delay: delay in seconds
+        :param target: the callable to run
+        :param args: positional arguments for the target
+        :param kwargs: keyword arguments for the target
+        :param run_in_thread: run the target in its own thread instead of on the scheduler thread
+        :return: ScheduledTask handle
+        """
+        task = ScheduledTask(self, target, args or (), kwargs or {}, run_in_thread)
+        self.reschedule(task, delay)
+        return task
+
+    def reschedule(self, task, delay):
+        """
+        Move the task to run after the delay, also re-arms cancelled or already executed tasks
+        :param task: the ScheduledTask handle
+        :param delay: delay in seconds
+        :return: None
+        """
+        with self._condition:
+            if self._stopped:
+                LOG.info("Scheduler stopped, not scheduling %s", task.target)
+                return
+
+            task.cancelled = False
+            task.when = time.monotonic() + max(delay, 0)
+            # Older heap entries of the task are stale now and skipped when popped
+            task.sequence = next(self._counter)
+            heapq.heappush(self._queue, (task.when, task.sequence, task))
+            self._condition.notify_all()
+
+        self.start()
+
+    def cancel(self, task):
+        with self._condition:
+            task.cancelled = True
+            task.sequence = None
+            self._condition.notify_all()
+
+    def _next_due_task(self):
+        with self._condition:
+            while not self._stopped:
+                # Drop stale entries of cancelled or rescheduled tasks
+                while self._queue and self._queue[0][2].sequence != self._queue[0][1]:
+                    heapq.heappop(self._queue)
+
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+
+                when, _, task = self._queue[0]
+                remaining = when - time.monotonic()
+
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+
+                heapq.heappop(self._queue)
+                task.sequence = None
+                return task
+
+            return None
+
+    def _run(self):
+        while True:
+            task = self._next_due_task()
+
+            if task is None:
+                return
+
+            if task.run_in_thread:
+                utils.run_threaded(task.target, args=task.args, kwargs=task.kwargs)
+                continue
+
+            try:
+                task.target(*task.args, **task.kwargs)
+            except Exception as error:
+                LOG.exception(error)
@@ -77,6 +77,10 @@ def window(key, value=None, clear=False, window_id=10000):
         return result
 
 
+# Settings read on hot paths (e.g. on every seek), kept until the settings change
+_settings_cache = {}
+
+
 def settings(setting, value=None):
     """Get or add add-on settings.
     getSetting returns unicode object.
@@ -84,6 +88,7 @@ def settings(setting, value=None):
     addon = xbmcaddon.Addon(addon_id())
 
     if value is not None:
+        _settings_cache.pop(setting, None)
         if setting.endswith(".bool"):
             setting = setting.replace(".bool", "")
             value = "true" if value else "false"
@@ -98,6 +103,32 @@ def settings(setting, value=None):
         return result
 
 
+def cached_settings(setting):
+    """Get an add-on setting, read once and kept until clear_settings_cache is called.
+    Every read of a setting creates an Addon instance, use this on hot paths.
+    """
+    try:
+        return _settings_cache[setting]
+    except KeyError:
+        value = _settings_cache[setting] = settings(setting)
+        return value
+
+
+def clear_settings_cache():
+    """Forget the cached settings, called when the settings changed."""
+    _settings_cache.clear()
+
+
+def settings_number(setting, default, cached=False):
+    """Get a numeric add-on setting, falling back to default if it is unset or invalid.
+    If cached is True, the setting is read through cached_settings.
+    """
+    try:
+        return type(default)(float(cached_settings(setting) if cached else settings(setting)))
+    except (TypeError, ValueError):
+        return default
+
+
 def create_id():
     return uuid4()
 
@@ -126,6 +157,18 @@ def translate_path(path):
         return xbmc.translatePath(path)
 
 
+def profile_path(*paths):
+    """
+    Return a path inside the add-on profile directory, creating the directory if needed
+    """
+    profile = translate_path("special://profile/addon_data/%s/" % addon_id())
+
+    if not os.path.isdir(profile):
+        os.makedirs(profile, exist_ok=True)
+
+    return os.path.join(profile, *paths)
+
+
 def run_threaded(target, delay=None, args=None, kwargs=None):
     """Executes the target in a separate thread or timer"""
 
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import json
+import os
+import threading
+from urllib.parse import urlsplit
+
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+JELLYFIN_DATA_PATH = "special://profile/addon_data/plugin.video.jellyfin/data.json"
+
+
+class JellyfinServer:
+    def __init__(self, server_id: str, name: str, address: str, access_token: str, user_id: str):
+        self.server_id = server_id
+        self.name = name
+        self.address = address.rstrip("/")
+        self.access_token = access_token
+        self.user_id = user_id
+
+    def get_hostname(self):
+        return (urlsplit(self.address).hostname or "").lower()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            server_id=data.get("Id"),
+            name=data.get("Name"),
+            address=data["address"],
+            access_token=data["AccessToken"],
+            user_id=data.get("UserId")
+        )
+
+    def __str__(self):
+        return f"{self.name} ({self.address})"
+
+
+class CredentialProvider:
+    """
+    Provides the Jellyfin servers configured in plugin.video.jellyfin.
+    The parsed data.json is cached and only read again when its modification time or size changes,
+    so server switches and token refreshes are picked up without restarting Kodi.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._signature = None
+        self._servers = []
+        self._lock = threading.Lock()
+
+    def get_servers(self):
+        """
+        Get the configured servers, re-reading data.json if it changed
+        :return: list of JellyfinServer
+        """
+        stat = os.stat(self.path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if signature != self._signature:
+                with open(self.path, "rb") as f:
+                    data = json.load(f)
+
+                self._servers = [JellyfinServer.from_dict(server) for server in data.get("Servers", [])]
+                self._signature = signature
+                LOG.info("Loaded %s Jellyfin servers from data.json", len(self._servers))
+
+            return self._servers
+
+    def get_server(self, server_id=None, user_id=None, playing_file=None):
+        """
+        Select the server of the playing item. Matches by server id, then user id, then the host of the playing file.
+        Falls back to the first configured server.
+
+        :param server_id: the Jellyfin ServerId of the playing item, if known
+        :param user_id: the Jellyfin UserId of the playing item, if known
+        :param playing_file: the path or url Kodi is playing, if known
+        :return: JellyfinServer
+        :raises LookupError: if no server is configured
+        """
+        servers = self.get_servers()
+
+        if not servers:
+            raise LookupError("No Jellyfin server configured in plugin.video.jellyfin")
+
+        if server_id:
+            for server in servers:
+                if server.server_id == server_id:
+                    return server
+
+        if user_id:
+            for server in servers:
+                if server.user_id == user_id:
+                    return server
+
+        playing_host = (urlsplit(playing_file).hostname or "").lower() if playing_file else ""
+        if playing_host:
+            for server in servers:
+                if server.get_hostname() == playing_host:
+                    return server
+
+        return servers[0]
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import gzip
+import http.client
+import json
+import random
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from helper import LazyLogger
+from helper.metrics import metrics
+
+LOG = LazyLogger(__name__)
+
+DEFAULT_TIMEOUT_SECONDS = 5
+DEFAULT_RETRIES = 2
+# Base delay of the exponential backoff between retries, jittered
+DEFAULT_BACKOFF_SECONDS = 0.2
+# Idle connections kept open per server
+MAX_IDLE_CONNECTIONS = 4
+# Size of the chunks a discarded response body is read in
+DISCARD_CHUNK_BYTES = 64 * 1024
+
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class HttpError(Exception):
+    def __init__(self, status, reason, url):
+        Exception.__init__(self, f"HTTP {status} {reason} for {url}")
+        self.status = status
+        self.reason = reason
+        self.url = url
+
+
+class HttpResponse:
+    def __init__(self, status, headers, body, length=None):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        # Size of the body as received, also set if the body was discarded
+        self.length = len(body) if length is None else length
+
+    def json(self):
+        with metrics.timer("json_parse"):
+            return json.loads(self.body)
+
+
+class HttpClient:
+    """
+    Small HTTP client keeping persistent (keep-alive) connections per server, so consecutive Jellyfin
+    requests skip the TCP and TLS handshakes. Responses may be gzip compressed. Failed requests on
+    connection errors or gateway errors are retried with a jittered exponential backoff.
+    Thread safe, connections are checked out of the idle pool for the duration of a request.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT_SECONDS, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _connection_key(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == "https" else 80)
+        return scheme, parts.hostname, port
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host, port = key
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            connection = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return connection, False
+
+    def _release(self, key, connection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def close(self):
+        """
+        Close all idle connections
+        :return: None
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, url, headers=None, method="GET", timeout=None, budget=None, discard_body=False,
+                max_length=None):
+        """
+        Send a request, retrying on connection and gateway errors
+        :param url: the absolute url
+        :param headers: extra request headers
+        :param method: the http method
+        :param timeout: timeout in seconds, defaults to the client timeout
+        :param budget: total time in seconds for all attempts and backoff delays, unlimited if None
+        :param discard_body: read the body in chunks without keeping it, e.g. to warm up caches
+        :param max_length: stop reading a discarded body after this many bytes and close the connection
+        :return: HttpResponse for 2xx and 304 responses
+        :raises HttpError: for any other status
+        :raises socket.timeout: if the budget is exhausted
+        """
+        key = self._connection_key(url)
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        request_headers = {"Accept-Encoding": "gzip", "Connection": "keep-alive"}
+        request_headers.update(headers or {})
+
+        start = time.perf_counter()
+        deadline = time.monotonic() + budget if budget else None
+        attempt = 0
+        while True:
+            attempt_timeout = timeout or self.timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.incr("http_budget_exceeded")
+                    raise socket.timeout(f"Latency budget of {budget} seconds exceeded for {url}")
+                attempt_timeout = min(attempt_timeout, remaining)
+
+            connection, reused = self._acquire(key)
+            connection.timeout = attempt_timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(connection.timeout)
+
+            try:
+                connection.request(method, path, headers=request_headers)
+                response = connection.getresponse()
+                if discard_body:
+                    body, length = b"", self._discard(response, max_length)
+                else:
+                    body = response.read()
+                    length = None
+            except (http.client.HTTPException, socket.error) as error:
+                connection.close()
+
+                # A kept-alive connection may have been closed by the server in the meantime, retry it right away
+                if reused and not isinstance(error, socket.timeout):
+                    LOG.info("Stale connection to %s, reconnecting: %s", key[1], error)
+                    continue
+
+                if attempt >= self.retries:
+                    metrics.incr("http_errors")
+                    raise
+                attempt += 1
+                metrics.incr("http_retries")
+                LOG.info("Request to %s failed (%s), retry %s/%s", url, error, attempt, self.retries)
+                self._sleep_backoff(attempt, deadline)
+                continue
+
+            if response.will_close or not response.isclosed():
+                # Closed by the server, or the rest of a discarded body is still unread
+                connection.close()
+            else:
+                self._release(key, connection)
+
+            if body and response.getheader("Content-Encoding", "").lower() == "gzip":
+                body = gzip.decompress(body)
+
+            if 200 <= response.status < 300 or response.status == 304:
+                metrics.record("http_request", time.perf_counter() - start)
+                return HttpResponse(response.status, response.headers, body, length)
+
+            if response.status in RETRY_STATUS_CODES and attempt < self.retries:
+                attempt += 1
+                metrics.incr("http_retries")
+                LOG.info("Request to %s returned %s, retry %s/%s", url, response.status, attempt, self.retries)
+                self._sleep_backoff(attempt, deadline)
+                continue
+
+            metrics.incr("http_errors")
+            raise HttpError(response.status, response.reason, url)
+
+    @staticmethod
+    def _discard(response, max_length=None):
+        length = 0
+        while max_length is None or length < max_length:
+            size = DISCARD_CHUNK_BYTES if max_length is None else min(DISCARD_CHUNK_BYTES, max_length - length)
+            chunk = response.read(size)
+            if not chunk:
+                break
+            length += len(chunk)
+        return length
+
+    def _sleep_backoff(self, attempt, deadline=None):
+        delay = self.backoff * (2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay * 1.5)
+        if deadline is not None:
+            # Don't sleep past the budget, the next attempt fails right away then
+            delay = min(delay, max(0, deadline - time.monotonic()))
+        time.sleep(delay)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import re
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+# Jellyfin ids are guids, usually without dashes
+ITEM_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$|^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.I)
+# Stream urls of the Jellyfin server, e.g. /Videos/{id}/stream.mkv, /Videos/{id}/master.m3u8 or /Items/{id}/Download
+STREAM_PATH_PATTERN = re.compile(r"/(?:videos|items|audio)/([0-9a-f-]{32,36})(?:/|$)", re.I)
+
+
+def normalize_item_id(item_id):
+    """
+    Return the item id in the dashless lower case form used by the Jellyfin API, or None if it is no valid id
+    """
+    if not item_id or not ITEM_ID_PATTERN.match(item_id):
+        return None
+    return item_id.replace("-", "").lower()
+
+
+class ItemIdResolver:
+    """
+    Resolves the Jellyfin ItemId of the playing file without waiting for plugin.video.jellyfin to broadcast it.
+    Understands plugin.video.jellyfin plugin urls and Jellyfin stream urls, other paths (e.g. native SMB/NFS paths)
+    are looked up with the optional path_lookup callable.
+    """
+
+    def __init__(self, path_lookup=None):
+        self.path_lookup = path_lookup
+
+    def resolve(self, playing_file):
+        """
+        Resolve the ItemId of the playing file
+        :param playing_file: the path or url Kodi is playing
+        :return: the ItemId or None if it could not be resolved
+        """
+        if not playing_file:
+            return None
+
+        item_id = self._resolve_from_url(playing_file)
+
+        if item_id is None and self.path_lookup is not None:
+            try:
+                item_id = self.path_lookup(playing_file)
+            except Exception as error:
+                LOG.info("Path lookup failed for %s: %s", playing_file, error)
+
+        return item_id
+
+    @staticmethod
+    def _resolve_from_url(playing_file):
+        parts = urlsplit(playing_file)
+        scheme = parts.scheme.lower()
+
+        if scheme == "plugin":
+            if parts.netloc != "plugin.video.jellyfin":
+                return None
+            query = parse_qs(parts.query)
+            return normalize_item_id(query.get("id", [None])[0])
+
+        if scheme in ("http", "https"):
+            match = STREAM_PATH_PATTERN.search(unquote(parts.path))
+            if match:
+                return normalize_item_id(match.group(1))
+
+        return None
@@ -1,87 +1,543 @@
 # -*- coding: utf-8 -*-
 # GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
 import json
-import urllib.request
+from collections import OrderedDict
+import threading
+import time
 import xbmcvfs
 
-from helper import LazyLogger
+from helper import LazyLogger, profile_path, settings, settings_number
+import helper.utils as utils
+from helper.metrics import metrics
 LOG = LazyLogger(__name__)
 
 from .media_segments import MediaSegmentResponse
+from .segment_cache import SegmentCache, DEFAULT_TTL_SECONDS, PUSH_INVALIDATION_TTL_SECONDS
+from .prefetcher import SegmentPrefetcher
+from .prebuffer import SkipTargetPrebuffer
+from .http_client import HttpClient, HttpError, DEFAULT_TIMEOUT_SECONDS, DEFAULT_RETRIES
+from .credentials import CredentialProvider, JELLYFIN_DATA_PATH
+from .itemid_resolver import ItemIdResolver
+from .path_index import PathIndex
+from .library_sync import LibrarySync, DEFAULT_WORKERS
+from .websocket import LibraryChangeListener, get_jellyfin_websocket_url
+
+# Amount of parsed MediaSegments responses kept in memory
+MEMORY_CACHE_SIZE = 50
+# Maximum time the MediaSegments request of the playing item may take, including retries
+DEFAULT_FETCH_BUDGET_SECONDS = 3
+# Items whose MediaSegments could not be fetched are not requested again for this long
+NEGATIVE_CACHE_SECONDS = 60
 
 class JellyfinHack:
-    def __init__(self):
+    def __init__(self, on_segments_changed=None):
         self.jellyfin_itemid = None
+        # True if the ItemId was resolved from the playing file, UserDataChanged notifications are ignored then
+        self._itemid_from_file = False
+        self._itemid_condition = threading.Condition()
+        self._itemid_generation = 0
         self._jellyfin_server = None
         self._jellyfin_apikey = None
+        self._credentials = None
+        # Hints to select the server of the playing item
+        self._server_id = None
+        self._user_id = None
+        self._playing_file = None
+        # Monotonic time of the playback start, for the latency metrics
+        self._playback_started = None
         self.media_segments = None
+        # Called when a background revalidation changed the segments of the playing item
+        self.on_segments_changed = on_segments_changed
+        self._segment_cache = None
+        # ItemId -> monotonic time until which failed fetches are not retried
+        self._failed_fetches = {}
+        self._revalidating = set()
+        self._revalidate_lock = threading.Lock()
+        self._memory_cache = OrderedDict()
+        self._memory_cache_lock = threading.Lock()
+        self.prefetcher = SegmentPrefetcher(self)
+        self.prebuffer = SkipTargetPrebuffer(self)
+        self._path_index = None
+        self.itemid_resolver = ItemIdResolver(path_lookup=self._lookup_path)
+        self.change_listener = None
+        self.library_sync = LibrarySync(self, max_workers=settings_number('sync_workers', DEFAULT_WORKERS))
+        self.http_client = HttpClient(timeout=settings_number('http_timeout', DEFAULT_TIMEOUT_SECONDS),
+                                      retries=settings_number('http_retries', DEFAULT_RETRIES))
 
     def event_handler_jellyfin_userdatachanged(self, _, **kwargs):
         if kwargs.get("sender") != "plugin.video.jellyfin":
             return
 
-        self.reset_itemid()
+        if self._itemid_from_file:
+            # Only a fallback, the notification may be about another item, e.g. the previous episode marked played
+            LOG.debug("ItemId resolved from the playing file, ignoring UserDataChanged")
+            return
 
         try:
-            self.jellyfin_itemid = json.loads(kwargs["data"])[0]["UserDataList"][0]["ItemId"]
-        except Exception:
-            self.jellyfin_itemid = None
+            data = json.loads(kwargs["data"])[0]
+            item_id = data["UserDataList"][0]["ItemId"]
+        except Exception as error:
+            LOG.debug("Could not parse UserDataChanged: %s", error)
+            return
+
+        if not item_id or item_id == self.jellyfin_itemid:
+            return
+
+        self._server_id = data.get("ServerId")
+        self._user_id = data.get("UserId")
+        self.reset_itemid()
+        self.set_itemid(item_id)
+        self.prefetcher.prefetch(item_id)
+
+    def set_playing_file(self, playing_file):
+        """
+        Remember the file Kodi is playing, used to select the Jellyfin server it is streamed from.
+        Server hints of the previous item are dropped.
+        :param playing_file: the path or url of the playing file
+        :return: None
+        """
+        self._playing_file = playing_file
+        self._playback_started = time.monotonic()
+        self._server_id = None
+        self._user_id = None
+
+    def resolve_itemid(self, playing_file):
+        """
+        Resolve the ItemId straight from the playing file, so segments can be requested without waiting for
+        the UserDataChanged notification of plugin.video.jellyfin
+        :param playing_file: the path or url of the playing file
+        :return: the ItemId or None if it could not be resolved
+        """
+        item_id = self.itemid_resolver.resolve(playing_file)
+
+        if item_id:
+            LOG.info("Resolved itemid %s from playing file", item_id)
+            self._itemid_from_file = True
+            self.set_itemid(item_id)
+            self.prefetcher.prefetch(item_id)
+
+        return item_id
 
     def setup_jellyfin_server(self):
-        if not self._jellyfin_server:
-            with open(xbmcvfs.translatePath("special://profile/addon_data/plugin.video.jellyfin/data.json"),
-                      "rb") as f:
-                jf_servers = json.load(f)
-            self._jellyfin_apikey = jf_servers["Servers"][0]["AccessToken"]
-            self._jellyfin_server = jf_servers["Servers"][0]["address"]
+        """
+        Select the Jellyfin server of the playing item. data.json is only parsed again when it changed on disk.
+        :return: JellyfinServer
+        """
+        if self._credentials is None:
+            self._credentials = CredentialProvider(xbmcvfs.translatePath(JELLYFIN_DATA_PATH))
 
-    def make_request(self, api_endpoint):
-        url = f"{self._jellyfin_server}/{api_endpoint}"
-        req = urllib.request.Request(url, headers={
+        server = self._credentials.get_server(self._server_id, self._user_id, self._playing_file)
+        self._jellyfin_server = server.address
+        self._jellyfin_apikey = server.access_token
+        return server
+
+    def _get_headers(self, server):
+        return {
             "Accept": "application/json",
-            "Authorization": f"MediaBrowser Token={self._jellyfin_apikey}",
-        })
+            "Authorization": f"MediaBrowser Token={server.access_token}",
+        }
+
+    def make_request(self, api_endpoint):
+        server = self.setup_jellyfin_server()
+        url = f"{server.address}/{api_endpoint}"
+        return self.http_client.request(url, headers=self._get_headers(server)).json()
+
+    def make_conditional_request(self, api_endpoint, etag=None, budget=None):
+        """
+        Request the endpoint, revalidating with If-None-Match when an ETag is known
+        :param api_endpoint: the api endpoint to request
+        :param etag: the ETag of the cached response, if any
+        :param budget: maximum time in seconds for the request including retries, unlimited if None
+        :return: tuple of (json response or None if not modified, ETag of the response)
+        """
+        server = self.setup_jellyfin_server()
+        url = f"{server.address}/{api_endpoint}"
+        headers = self._get_headers(server)
+        if etag:
+            headers["If-None-Match"] = etag
+
+        response = self.http_client.request(url, headers=headers, budget=budget)
+
+        if response.status == 304:
+            return None, etag
+
+        return response.json(), response.headers.get("ETag")
 
-        with urllib.request.urlopen(req, timeout=5) as response:
-            return json.load(response)
+    def make_range_request(self, api_endpoint, start, end):
+        """
+        Read a byte range of the endpoint without keeping the data, to warm up the caches of the server
+        :param api_endpoint: the api endpoint to request
+        :param start: first byte of the range
+        :param end: last byte of the range, inclusive
+        :return: amount of bytes read
+        :raises HttpError: if the server ignored the range
+        """
+        server = self.setup_jellyfin_server()
+        url = f"{server.address}/{api_endpoint}"
+        headers = self._get_headers(server)
+        headers["Accept"] = "*/*"
+        headers["Range"] = f"bytes={start}-{end}"
+        # A server or proxy ignoring the range sends the whole file, never read more than the range
+        response = self.http_client.request(url, headers=headers, discard_body=True, max_length=end - start + 1)
+
+        if response.status != 206:
+            raise HttpError(response.status, "Range not supported", url)
+        return response.length
 
     def has_itemid(self):
         return self.jellyfin_itemid is not None
 
+    def set_itemid(self, item_id):
+        """
+        Set the ItemId of the playing item and wake up everyone waiting for it
+        :param item_id: the Jellyfin ItemId
+        :return: None
+        """
+        with self._itemid_condition:
+            self.jellyfin_itemid = item_id
+            self._itemid_condition.notify_all()
+
+        if item_id and self._playback_started is not None:
+            metrics.record("play_to_itemid", time.monotonic() - self._playback_started)
+
     def reset_itemid(self):
-        self.jellyfin_itemid = None
-        self.media_segments = None
+        """
+        Forget the playing item. Threads waiting in wait_for_itemid are cancelled.
+        :return: None
+        """
+        with self._itemid_condition:
+            self.jellyfin_itemid = None
+            self._itemid_from_file = False
+            self.media_segments = None
+            self._itemid_generation += 1
+            self._itemid_condition.notify_all()
 
-    def get_media_segments(self):
-        if self.media_segments is None:
+    def wait_for_itemid(self, timeout):
+        """
+        Block until the ItemId of the playing item is known, the wait is cancelled by reset_itemid or the timeout
+        expires.
+
+        :param timeout: maximum time to wait in seconds
+        :return: the ItemId, or None if cancelled or timed out
+        """
+        with self._itemid_condition:
+            generation = self._itemid_generation
+            self._itemid_condition.wait_for(
+                lambda: self.jellyfin_itemid is not None or self._itemid_generation != generation, timeout
+            )
+
+            if self._itemid_generation != generation:
+                return None
+
+            return self.jellyfin_itemid
+
+    def get_media_segments(self, fetch=True):
+        """
+        Get the media segments of the playing item
+        :param fetch: if True, fetch the media segments when they are not loaded yet
+        :return: MediaSegmentResponse or None
+        """
+        if self.media_segments is None and fetch:
             self._fetch_media_segments()
         return self.media_segments
 
-    def _fetch_media_segments(self):
-        ret = None
-        try:
-            if self.jellyfin_itemid:
-                self.setup_jellyfin_server()
-                api_endpoint = f"MediaSegments/{self.jellyfin_itemid}"
+    def get_segment_cache(self):
+        if self._segment_cache is None:
+            # Pushed invalidations keep the cache fresh, so entries can live much longer
+            ttl_seconds = PUSH_INVALIDATION_TTL_SECONDS if self.is_push_invalidation_enabled() else DEFAULT_TTL_SECONDS
+            self._segment_cache = SegmentCache(profile_path("segments.db"), ttl_seconds=ttl_seconds)
+        return self._segment_cache
+
+    @staticmethod
+    def is_push_invalidation_enabled():
+        return settings('websocket_invalidation.bool') is True
 
-                ret = self.make_request(api_endpoint)
+    def start_change_listener(self):
+        """
+        Start listening to library changes on the Jellyfin websocket, if enabled in the settings
+        :return: None
+        """
+        if not self.is_push_invalidation_enabled():
+            return
 
-                media_segments_response = MediaSegmentResponse.from_json(ret)
-                self.media_segments = media_segments_response
+        if self.change_listener is None:
+            self.change_listener = LibraryChangeListener(
+                lambda: get_jellyfin_websocket_url(self.setup_jellyfin_server()), self.invalidate_media_segments
+            )
+        self.change_listener.start()
 
-                LOG.info(f"MediaSegments: {media_segments_response}")
-            else:
-                LOG.info("No itemid")
-        except Exception:
-            pass
+    def stop_change_listener(self):
+        if self.change_listener is not None:
+            self.change_listener.stop()
+
+    def close(self):
+        """
+        Write the pending cache access times and close the cache databases and idle HTTP connections
+        :return: None
+        """
+        if self._segment_cache is not None:
+            self._segment_cache.close()
+        if self._path_index is not None:
+            self._path_index.close()
+        self.http_client.close()
+
+    def invalidate_media_segments(self, item_ids):
+        """
+        Refresh the cached media segments of changed items, items that are not cached are ignored.
+        The playing item is always refreshed, and tracking follows its new segments right away.
+        :param item_ids: the changed Jellyfin ItemIds
+        :return: None
+        """
+        cache = self.get_segment_cache()
+
+        for item_id in item_ids:
+            playing = item_id == self.jellyfin_itemid and self.media_segments is not None
+
+            if not playing and not cache.has(item_id):
+                with self._memory_cache_lock:
+                    self._memory_cache.pop(item_id, None)
+                continue
+
+            try:
+                payload = self.refresh_media_segments(item_id)
+            except Exception as error:
+                LOG.info("Could not refresh media segments of %s, removing them from the cache: %s", item_id, error)
+                cache.delete(item_id)
+                with self._memory_cache_lock:
+                    self._memory_cache.pop(item_id, None)
+                if playing:
+                    # Don't skip with stale times, loaded again on the next player event
+                    self.media_segments = None
+                continue
+
+            if playing:
+                self._update_media_segments(item_id, payload)
+
+    def get_path_index(self):
+        if self._path_index is None:
+            self._path_index = PathIndex(profile_path("library.db"))
+        return self._path_index
+
+    def _lookup_path(self, playing_file):
+        return self.get_path_index().lookup(playing_file)
+
+    def refresh_path_index(self):
+        """
+        Update the local path to ItemId index with the items saved in the library since the last refresh
+        :return: amount of items updated
+        """
+        return self.get_path_index().refresh(self)
+
+    def sync_library(self):
+        """
+        Store the media segments of all library items changed since the last sync in the local cache
+        :return: amount of items synced
+        """
+        return self.library_sync.sync()
+
+    def refresh_media_segments(self, item_id):
+        """
+        Revalidate the cached media segments of the item with the server, regardless of their age
+        :param item_id: the Jellyfin ItemId
+        :return: the MediaSegments json response
+        """
+        payload, _ = self._load_media_segments(item_id, revalidate=True)
+
+        # Parsed again on next use
+        with self._memory_cache_lock:
+            self._memory_cache.pop(item_id, None)
+
+        return payload
+
+    def _load_media_segments(self, item_id, revalidate=False, allow_stale=False, budget=None):
+        """
+        Load the MediaSegments json of the item from the local cache, going to the server only if the cached entry
+        is missing or expired. Expired entries are revalidated using their ETag.
+
+        :param item_id: the Jellyfin ItemId
+        :param revalidate: if True, revalidate the cached entry even if it did not expire yet
+        :param allow_stale: if True, return an expired entry as is, the caller revalidates it later
+        :param budget: maximum time in seconds for the server request, unlimited if None
+        :return: tuple of (the MediaSegments json response, True if it is an expired entry)
+        """
+        cache = self.get_segment_cache()
+        entry = cache.get(item_id)
+
+        if entry and not revalidate:
+            if entry.is_fresh(cache.ttl_seconds):
+                LOG.debug("MediaSegments cache hit for %s", item_id)
+                metrics.incr("segment_cache_disk_hit")
+                return entry.payload, False
+
+            if allow_stale:
+                LOG.debug("MediaSegments cache hit for %s, expired", item_id)
+                metrics.incr("segment_cache_stale_hit")
+                return entry.payload, True
+
+        if not revalidate:
+            metrics.incr("segment_cache_miss")
+
+        payload, etag = self.make_conditional_request(f"MediaSegments/{item_id}", entry.etag if entry else None,
+                                                      budget=budget)
+
+        if payload is None and entry:
+            LOG.info("MediaSegments for %s not modified", item_id)
+            metrics.incr("segment_cache_not_modified")
+            cache.touch(item_id)
+            return entry.payload, False
+
+        cache.put(item_id, payload, etag)
+        return payload, False
+
+    def revalidate_async(self, item_id, stale_payload):
+        """
+        Revalidate expired media segments with the server in a background thread.
+        If they changed and the item is still playing, the tracked segments are replaced and on_segments_changed
+        is called.
+
+        :param item_id: the Jellyfin ItemId
+        :param stale_payload: the expired MediaSegments json currently in use
+        :return: None
+        """
+        with self._revalidate_lock:
+            if item_id in self._revalidating:
+                return
+            self._revalidating.add(item_id)
+
+        utils.run_threaded(self._revalidate, kwargs={'item_id': item_id, 'stale_payload': stale_payload})
+
+    def _revalidate(self, item_id, stale_payload):
+        try:
+            payload, _ = self._load_media_segments(item_id, revalidate=True)
+        except Exception as error:
+            LOG.info("Could not revalidate media segments of %s: %s", item_id, error)
+            metrics.incr("segment_revalidate_errors")
+            return
         finally:
-            return ret
+            with self._revalidate_lock:
+                self._revalidating.discard(item_id)
+
+        if payload == stale_payload:
+            metrics.incr("segment_revalidate_unchanged")
+            return
+
+        metrics.incr("segment_revalidate_changed")
+        self._update_media_segments(item_id, payload)
+
+    def _update_media_segments(self, item_id, payload):
+        """
+        Replace the parsed media segments of an item that changed on the server. If it is playing, tracking is
+        updated right away.
+        :param item_id: the Jellyfin ItemId
+        :param payload: the new MediaSegments json response
+        :return: None
+        """
+        with metrics.timer("segment_parse"):
+            media_segments = MediaSegmentResponse.from_json(payload)
+        self._set_memory_cached(item_id, media_segments)
+
+        if item_id == self.jellyfin_itemid and self.media_segments is not None:
+            LOG.info("Media segments of %s changed on the server, updating", item_id)
+            self.media_segments = media_segments
+            if self.on_segments_changed is not None:
+                self.on_segments_changed()
+
+    def is_fetch_failed(self, item_id):
+        """
+        Check whether fetching the media segments of the item failed recently
+        :param item_id: the Jellyfin ItemId
+        :return: True if the item should not be requested again yet
+        """
+        with self._memory_cache_lock:
+            retry_at = self._failed_fetches.get(item_id)
+            if retry_at is None:
+                return False
+            if time.monotonic() >= retry_at:
+                del self._failed_fetches[item_id]
+                return False
+            return True
+
+    def _remember_failed_fetch(self, item_id):
+        with self._memory_cache_lock:
+            self._failed_fetches[item_id] = time.monotonic() + NEGATIVE_CACHE_SECONDS
+
+    def is_memory_cached(self, item_id):
+        with self._memory_cache_lock:
+            return item_id in self._memory_cache
+
+    def _get_memory_cached(self, item_id):
+        with self._memory_cache_lock:
+            media_segments = self._memory_cache.get(item_id)
+            if media_segments is not None:
+                self._memory_cache.move_to_end(item_id)
+            return media_segments
+
+    def _set_memory_cached(self, item_id, media_segments):
+        with self._memory_cache_lock:
+            self._memory_cache[item_id] = media_segments
+            self._memory_cache.move_to_end(item_id)
+            while len(self._memory_cache) > MEMORY_CACHE_SIZE:
+                self._memory_cache.popitem(last=False)
+
+    def load_media_segments_into_memory(self, item_id, allow_stale=False, budget=None):
+        """
+        Load and parse the media segments of the item into the in-memory cache
+        :param item_id: the Jellyfin ItemId
+        :param allow_stale: if True, use expired cached segments right away and revalidate them in the background
+        :param budget: maximum time in seconds for the server request, unlimited if None
+        :return: MediaSegmentResponse
+        """
+        payload, stale = self._load_media_segments(item_id, allow_stale=allow_stale, budget=budget)
+        with metrics.timer("segment_parse"):
+            media_segments = MediaSegmentResponse.from_json(payload)
+        self._set_memory_cached(item_id, media_segments)
+
+        if stale:
+            self.revalidate_async(item_id, payload)
+
+        return media_segments
+
+    def _fetch_media_segments(self):
+        item_id = self.jellyfin_itemid
+        if not item_id:
+            LOG.info("No itemid")
+            return None
+
+        media_segments_response = self._get_memory_cached(item_id)
+
+        if media_segments_response is not None:
+            LOG.debug("MediaSegments memory cache hit for %s", item_id)
+            metrics.incr("segment_cache_memory_hit")
+        elif self.is_fetch_failed(item_id):
+            LOG.debug("Fetching MediaSegments for %s failed recently, not retrying yet", item_id)
+            metrics.incr("segment_fetch_suppressed")
+            return None
+        else:
+            try:
+                media_segments_response = self.load_media_segments_into_memory(
+                    item_id, allow_stale=True, budget=settings_number('fetch_budget', DEFAULT_FETCH_BUDGET_SECONDS)
+                )
+            except Exception as error:
+                LOG.info("Could not fetch media segments of %s: %s", item_id, error)
+                metrics.incr("segment_fetch_errors")
+                self._remember_failed_fetch(item_id)
+                return None
+
+        # Playback may have changed while fetching
+        if item_id == self.jellyfin_itemid:
+            self.media_segments = media_segments_response
+
+            if self._playback_started is not None:
+                metrics.record("play_to_segments", time.monotonic() - self._playback_started)
+                self._playback_started = None
+
+        LOG.debug("MediaSegments: %s", media_segments_response)
+        return media_segments_response
 
     def get_credits_time(self):
         ret = 0
         try:
             if self.jellyfin_itemid:
-                self.setup_jellyfin_server()
                 api_endpoint = f"Episode/{self.jellyfin_itemid}/IntroTimestamps/v1?mode=Credits"
 
                 ret = self.make_request(api_endpoint)["IntroStart"]
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import xbmc
+
+from helper import LazyLogger
+
+from .path_index import iter_library_pages
+
+LOG = LazyLogger(__name__)
+
+# Concurrent MediaSegments requests during a sync
+DEFAULT_WORKERS = 4
+# Maximum amount of expired cache entries revalidated per sync
+MAX_REVALIDATIONS = 500
+# Maximum amount of failed items remembered for the next sync, if more fail the watermark is kept instead
+MAX_FAILED_ITEMS = 5000
+
+
+class LibrarySync:
+    """
+    Copies the media segments of the whole library into the local segment cache.
+    Pages through the library items saved since the last sync (watermark), stores their paths in the path index
+    and fetches their media segments with a bounded pool of workers. Expired cache entries are revalidated too,
+    so playback start finds everything locally. Items that failed are retried on the next sync.
+    """
+
+    def __init__(self, jellyfin, max_workers=DEFAULT_WORKERS):
+        self.jellyfin = jellyfin
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._monitor = xbmc.Monitor()
+
+    def sync(self):
+        """
+        Run a sync, does nothing if a sync is already running
+        :return: amount of items whose media segments were stored
+        """
+        if not self._lock.acquire(blocking=False):
+            LOG.info("Library sync already running")
+            return 0
+
+        try:
+            return self._sync()
+        finally:
+            self._lock.release()
+
+    def _sync(self):
+        server = self.jellyfin.setup_jellyfin_server()
+        path_index = self.jellyfin.get_path_index()
+        watermark_key = f"sync_watermark:{server.server_id}"
+        failed_key = f"sync_failed:{server.server_id}"
+        watermark = path_index.get_meta(watermark_key)
+        retry_item_ids = json.loads(path_index.get_meta(failed_key) or "[]")
+        started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        start_time = time.monotonic()
+        synced = 0
+        failed = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            def sync_items(item_ids):
+                # Waits for all items, so at most one page of requests is queued
+                stored = 0
+                for item_id, result in zip(item_ids, executor.map(self._sync_item, item_ids)):
+                    if result:
+                        failed.discard(item_id)
+                        stored += 1
+                    else:
+                        failed.add(item_id)
+                return stored
+
+            synced += sync_items(retry_item_ids)
+
+            for items in iter_library_pages(self.jellyfin, server, fields="Path", min_date_last_saved=watermark):
+                if self._monitor.abortRequested():
+                    break
+                path_index.add_items(items)
+                synced += sync_items([item["Id"] for item in items if item.get("Id")])
+
+            if not self._monitor.abortRequested():
+                synced += sync_items(self.jellyfin.get_segment_cache().get_stale_item_ids(MAX_REVALIDATIONS))
+
+        path_index.set_meta(failed_key, json.dumps(sorted(failed)[:MAX_FAILED_ITEMS]))
+
+        if self._monitor.abortRequested():
+            # Not all pages were handled, the next sync starts from the same watermark
+            LOG.info("Library sync aborted after %s items", synced)
+            return synced
+
+        if len(failed) > MAX_FAILED_ITEMS:
+            LOG.info("Media segments of %s items failed to sync, keeping the watermark", len(failed))
+        else:
+            path_index.set_meta(watermark_key, started)
+
+        LOG.info("Library sync stored media segments of %s items in %.1f seconds, %s failed",
+                 synced, time.monotonic() - start_time, len(failed))
+        return synced
+
+    def _sync_item(self, item_id):
+        """
+        :return: True if the media segments were stored, False if the request failed or Kodi is shutting down
+        """
+        if self._monitor.abortRequested():
+            return False
+
+        try:
+            self.jellyfin.refresh_media_segments(item_id)
+            return True
+        except Exception as error:
+            LOG.info("Could not sync media segments of %s: %s", item_id, error)
+            return False
@@ -1,6 +1,11 @@
 import json
+import sys
+from bisect import bisect_left, bisect_right
 from enum import Enum
-from typing import List
+from typing import List, Optional
+
+# Segments starting at most this long after the previous one ended are merged into one skip range
+DEFAULT_MERGE_GAP_SECONDS = 2
 
 class SegmentType(Enum):
     UNKNOWN = "Unknown"
@@ -11,31 +16,59 @@ class SegmentType(Enum):
     INTRO = "Intro"
 
 class MediaSegmentItem:
-    def __init__(self, itemId: str, item_id: str, segment_type: SegmentType, start_ticks: int, end_ticks: int):
-        self.itemId = itemId
-        self.item_id = item_id
-        self.segment_type = segment_type
-        self.start_ticks = start_ticks
-        self.end_ticks = end_ticks
-
+    """
+    Immutable media segment. Start and end seconds are computed once, item ids are interned since all segments
+    of an item share the same id, so items are cheap to hash and compare.
+    A segment merged from several segments keeps the type of the first one and lists all types in merged_types.
+    """
+
+    __slots__ = ("segment_id", "item_id", "segment_type", "start_ticks", "end_ticks", "start_seconds", "end_seconds",
+                 "merged_types", "_key", "_hash")
+
+    def __init__(self, segment_id: str, item_id: str, segment_type: SegmentType, start_ticks: int, end_ticks: int,
+                 merged_types=None):
+        start_seconds = self.ticks_to_seconds(start_ticks)
+        end_seconds = self.ticks_to_seconds(end_ticks)
+        item_id = sys.intern(item_id)
+        merged_types = tuple(merged_types) if merged_types else (segment_type,)
+        key = (item_id, segment_type, start_seconds, end_seconds)
+
+        for name, value in (("segment_id", segment_id), ("item_id", item_id), ("segment_type", segment_type),
+                            ("start_ticks", start_ticks), ("end_ticks", end_ticks),
+                            ("start_seconds", start_seconds), ("end_seconds", end_seconds),
+                            ("merged_types", merged_types), ("_key", key), ("_hash", hash(key))):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
 
     def get_segment_type_display(self):
-        return self.segment_type.value
+        return " & ".join(segment_type.value for segment_type in self.merged_types)
+
+    def merge(self, other: "MediaSegmentItem") -> "MediaSegmentItem":
+        """
+        Get a segment spanning this segment and the other one, which starts at the same time or later
+        """
+        merged_types = self.merged_types + tuple(segment_type for segment_type in other.merged_types
+                                                 if segment_type not in self.merged_types)
+        return MediaSegmentItem(self.segment_id, self.item_id, self.segment_type, self.start_ticks,
+                                max(self.end_ticks, other.end_ticks), merged_types)
 
     def get_start_seconds(self):
-        return self.ticks_to_seconds(self.start_ticks)
+        return self.start_seconds
 
     def get_end_seconds(self):
-        return self.ticks_to_seconds(self.end_ticks)
+        return self.end_seconds
 
     @staticmethod
-    def ticks_to_seconds(ticks: int) -> int:
-        return ticks // 10000000
+    def ticks_to_seconds(ticks: int) -> float:
+        # Ticks are 100 nanoseconds, keep the sub-second part so skips land exactly on the segment bounds
+        return ticks / 10000000
 
     @classmethod
     def from_dict(cls, data: dict):
         return cls(
-            itemId=data["Id"],
+            segment_id=data["Id"],
             item_id=data["ItemId"],
             segment_type=SegmentType(data["Type"]),
             start_ticks=data["StartTicks"],
@@ -49,20 +82,76 @@ class MediaSegmentItem:
         if not isinstance(other, MediaSegmentItem):
             return False
 
-        same_item_id = other.item_id == self.item_id
-        same_type = other.segment_type == self.segment_type
-        same_start = other.get_start_seconds() == self.get_start_seconds()
-        same_end = other.get_end_seconds() == self.get_end_seconds()
+        # Same item, type, start and end seconds
+        return self._key == other._key
+
+    def __hash__(self):
+        return self._hash
+
+class SegmentIndex:
+    """
+    Interval index over segment items, sorted by start time.
+    Keeps the start times and the running maximum of the end times, so both the segment currently playing
+    and the next upcoming segment are found with a binary search.
+    """
+
+    def __init__(self, items: List[MediaSegmentItem]):
+        # Sorting is stable, items starting at the same time keep their response order
+        self.items = sorted(items, key=lambda item: item.get_start_seconds())
+        self.starts = [item.get_start_seconds() for item in self.items]
+        self.max_ends = []
+
+        max_end = None
+        for item in self.items:
+            end_seconds = item.get_end_seconds()
+            max_end = end_seconds if max_end is None else max(max_end, end_seconds)
+            self.max_ends.append(max_end)
+
+    def get_current_item(self, current_seconds) -> Optional[MediaSegmentItem]:
+        """
+        Get the item currently playing (start < current_seconds < end), the earliest starting one if several overlap
+        """
+        # Items before this index start before the current time
+        started = bisect_left(self.starts, current_seconds)
+        # First item whose end, or the end of an earlier item, lies after the current time
+        index = bisect_right(self.max_ends, current_seconds, 0, started)
+
+        if index < started:
+            return self.items[index]
+        return None
+
+    def get_upcoming_item(self, current_seconds) -> Optional[MediaSegmentItem]:
+        """
+        Get the first item starting after current_seconds
+        """
+        index = bisect_right(self.starts, current_seconds)
+
+        if index < len(self.items):
+            return self.items[index]
+        return None
 
-        return same_item_id and same_type and same_start and same_end
 
 class MediaSegmentResponse:
     def __init__(self, items: List[MediaSegmentItem], total_record_count: int, start_index: int):
         self.items = items
         self.total_record_count = total_record_count
         self.start_index = start_index
-
-    def get_next_item(self, current_seconds, only_upcoming=False):
+        self._index = SegmentIndex(items)
+        self._type_indexes = {}
+        self._normalized = {}
+        self._filtered = {}
+
+    def _get_index(self, segment_type: Optional[SegmentType]) -> SegmentIndex:
+        if segment_type is None:
+            return self._index
+
+        index = self._type_indexes.get(segment_type)
+        if index is None:
+            index = SegmentIndex(self.get_items_by_type(segment_type))
+            self._type_indexes[segment_type] = index
+        return index
+
+    def get_next_item(self, current_seconds, only_upcoming=False, segment_type: Optional[SegmentType] = None):
         """
         Get the next item in the list based on the current time in seconds.
         If only_upcoming is True, it will only return upcoming items.
@@ -72,23 +161,75 @@ class MediaSegmentResponse:
 
         :param current_seconds: The current time in seconds.
         :param only_upcoming: If True, only return upcoming items. If False, return the first item that is currently playing or the next upcoming item.
+        :param segment_type: If set, only consider items of this segment type.
         :return: The next item in the list based on the current time in seconds.
         """
-        smallest_difference = None
-        item_to_return = None
-        for item in self.items:
-            start_seconds = item.get_start_seconds()
-            end_seconds = item.get_end_seconds()
+        index = self._get_index(segment_type)
+
+        if not only_upcoming:
+            current_item = index.get_current_item(current_seconds)
+            if current_item:
+                return current_item
+
+        return index.get_upcoming_item(current_seconds)
+
+    def exclude(self, segment_types):
+        """
+        Get the segments without those of the given types, e.g. the types the user chose to ignore
+        :param segment_types: collection of SegmentType to leave out
+        :return: MediaSegmentResponse, cached per types, self if no segment was left out
+        """
+        cache_key = frozenset(segment_types)
+
+        filtered = self._filtered.get(cache_key)
+        if filtered is not None:
+            return filtered
+
+        items = [item for item in self.items if item.segment_type not in cache_key]
+        filtered = self if len(items) == len(self.items) else MediaSegmentResponse(items, len(items), self.start_index)
+        self._filtered[cache_key] = filtered
+        return filtered
+
+    def normalize(self, max_gap_seconds=DEFAULT_MERGE_GAP_SECONDS, merge_key=None):
+        """
+        Merge overlapping and near-adjacent segments into skip ranges, so a single seek skips the whole run,
+        e.g. a recap directly followed by the intro.
+
+        :param max_gap_seconds: maximum time between the end of a segment and the start of the next one to merge them
+        :param merge_key: callable returning a key for a segment type, only segments with equal keys are merged and
+                          segments with the key None are never merged. By default all segment types are merged.
+        :return: MediaSegmentResponse of the skip ranges, cached per gap and keys
+        """
+        keys = tuple(merge_key(segment_type) if merge_key else True for segment_type in SegmentType)
+        cache_key = (max_gap_seconds, keys)
+
+        normalized = self._normalized.get(cache_key)
+        if normalized is not None:
+            return normalized
+
+        type_keys = dict(zip(SegmentType, keys))
+        items = []
+        run = None
+        run_key = None
+
+        for item in self._index.items:
+            key = type_keys[item.segment_type]
+
+            if run is not None and key is not None and key == run_key and \
+                    item.get_start_seconds() <= run.get_end_seconds() + max_gap_seconds:
+                run = run.merge(item)
+                continue
 
-            if start_seconds < current_seconds < end_seconds and not only_upcoming:
-                return item
+            if run is not None:
+                items.append(run)
+            run, run_key = item, key
 
-            if start_seconds > current_seconds:
-                if not smallest_difference or start_seconds - current_seconds < smallest_difference:
-                    smallest_difference = start_seconds - current_seconds
-                    item_to_return = item
+        if run is not None:
+            items.append(run)
 
-        return item_to_return
+        normalized = self if len(items) == len(self.items) else MediaSegmentResponse(items, len(items), self.start_index)
+        self._normalized[cache_key] = normalized
+        return normalized
 
     @classmethod
     def from_json(cls, json_dict: dict):
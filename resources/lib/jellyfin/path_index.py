@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote
+
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+# Amount of library items requested per page
+PAGE_SIZE = 500
+ITEM_TYPES = "Movie,Episode"
+# Trailing path components that must match, the file name alone is too generic (e.g. S01E01.mkv)
+MIN_MATCHING_COMPONENTS = 2
+
+
+def split_path(path):
+    """
+    Split a local path, Kodi vfs url or Jellyfin server path into its lower case components.
+    Protocol and host are dropped, so paths of different mount roots share their trailing components.
+    """
+    path = unquote(path).replace("\\", "/")
+
+    if "://" in path:
+        # smb://host/share/file -> share/file
+        path = path.split("://", 1)[1].split("/", 1)[-1]
+
+    return [component for component in path.lower().split("/") if component]
+
+
+def common_suffix_length(first, second):
+    length = 0
+    for a, b in zip(reversed(first), reversed(second)):
+        if a != b:
+            break
+        length += 1
+    return length
+
+
+class PathIndex:
+    """
+    Maps media file paths of the Jellyfin library to their ItemIds.
+    Paths are matched by file name first and then by the longest common trailing path, so a file is found even if
+    Kodi mounts the library under a different root than the Jellyfin server.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._connection = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS paths ("
+                "item_id TEXT PRIMARY KEY, "
+                "filename TEXT NOT NULL, "
+                "path TEXT NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS paths_filename ON paths (filename)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._connection.commit()
+        return self._connection
+
+    def lookup(self, playing_file):
+        """
+        Look up the ItemId of a playing file. Besides the file name, at least its folder has to match.
+        :param playing_file: the path or url Kodi is playing
+        :return: the ItemId, or None if the file is unknown or ambiguous
+        """
+        components = split_path(playing_file)
+        if not components:
+            return None
+
+        with self._lock:
+            rows = self._get_connection().execute(
+                "SELECT item_id, path FROM paths WHERE filename = ?", (components[-1],)
+            ).fetchall()
+
+        best_item_id = None
+        best_length = MIN_MATCHING_COMPONENTS - 1
+        for item_id, path in rows:
+            length = common_suffix_length(components, path.split("/"))
+            if length > best_length:
+                best_item_id, best_length = item_id, length
+            elif length == best_length:
+                # Same file name and folders, can't tell which one is playing
+                best_item_id = None
+
+        return best_item_id
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self._get_connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+            connection.commit()
+
+    def add_items(self, items):
+        """
+        Add or update library items
+        :param items: Jellyfin item dicts with at least Id and Path
+        :return: amount of items stored
+        """
+        rows = []
+        for item in items:
+            components = split_path(item.get("Path") or "")
+            if item.get("Id") and components:
+                rows.append((item["Id"], components[-1], "/".join(components)))
+
+        with self._lock:
+            connection = self._get_connection()
+            connection.executemany("INSERT OR REPLACE INTO paths (item_id, filename, path) VALUES (?, ?, ?)", rows)
+            connection.commit()
+
+        return len(rows)
+
+    def refresh(self, jellyfin):
+        """
+        Page through the Jellyfin library and store the paths of all items saved since the last refresh
+        :param jellyfin: the JellyfinHack used for requests
+        :return: amount of items updated
+        """
+        if not self._refresh_lock.acquire(blocking=False):
+            LOG.info("Path index refresh already running")
+            return 0
+
+        try:
+            server = jellyfin.setup_jellyfin_server()
+            watermark_key = f"watermark:{server.server_id}"
+            watermark = self.get_meta(watermark_key)
+            started = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            start_time = time.monotonic()
+
+            updated = 0
+            for items in iter_library_pages(jellyfin, server, fields="Path", min_date_last_saved=watermark):
+                updated += self.add_items(items)
+
+            self.set_meta(watermark_key, started)
+            LOG.info("Path index refreshed, %s items updated in %.1f seconds", updated, time.monotonic() - start_time)
+            return updated
+        finally:
+            self._refresh_lock.release()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def iter_library_pages(jellyfin, server, fields="", min_date_last_saved=None, page_size=PAGE_SIZE):
+    """
+    Iterate over the movies and episodes of the Jellyfin library, page by page
+    :param jellyfin: the JellyfinHack used for requests
+    :param server: the JellyfinServer to page through
+    :param fields: additional item fields to request
+    :param min_date_last_saved: only return items saved after this ISO date, if set
+    :param page_size: amount of items per request
+    :return: generator of item lists
+    """
+    start_index = 0
+    while True:
+        api_endpoint = (f"Users/{server.user_id}/Items?Recursive=true&IncludeItemTypes={ITEM_TYPES}"
+                        f"&Fields={fields}&EnableImages=false&EnableUserData=false"
+                        f"&SortBy=DateCreated&StartIndex={start_index}&Limit={page_size}")
+        if min_date_last_saved:
+            api_endpoint += f"&MinDateLastSaved={quote(min_date_last_saved)}"
+
+        response = jellyfin.make_request(api_endpoint)
+        items = response.get("Items", [])
+
+        if items:
+            yield items
+
+        start_index += len(items)
+        if not items or start_index >= response.get("TotalRecordCount", 0):
+            return
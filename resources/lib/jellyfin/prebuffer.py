@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import threading
+
+import helper.utils as utils
+from helper import LazyLogger
+from helper.metrics import metrics
+
+LOG = LazyLogger(__name__)
+
+# Seconds of the stream read after the skip target, overridden by the prebuffer_seconds setting
+DEFAULT_PREBUFFER_SECONDS = 5
+# Seconds read before the estimated position of the skip target, the estimate assumes a constant bitrate
+LEAD_IN_SECONDS = 2
+TICKS_PER_SECOND = 10000000
+
+
+def get_byte_range(media_source, runtime_ticks, target_seconds, seconds=DEFAULT_PREBUFFER_SECONDS):
+    """
+    Estimate the bytes of a media file around a timestamp. The average rate is taken from the file size and
+    runtime, or from the bitrate if the size is unknown.
+
+    :param media_source: the Jellyfin MediaSource dict of the file
+    :param runtime_ticks: the runtime of the item in ticks
+    :param target_seconds: the timestamp in seconds
+    :param seconds: the amount of seconds to cover after the timestamp
+    :return: tuple of (first byte, last byte), or None if neither size nor bitrate are known
+    """
+    size = media_source.get("Size")
+    bitrate = media_source.get("Bitrate")
+    runtime_seconds = (runtime_ticks or media_source.get("RunTimeTicks") or 0) / TICKS_PER_SECOND
+
+    if size and runtime_seconds:
+        bytes_per_second = size / runtime_seconds
+    elif bitrate:
+        bytes_per_second = bitrate / 8
+    else:
+        return None
+
+    start = max(0, int((target_seconds - LEAD_IN_SECONDS) * bytes_per_second))
+    end = start + int((seconds + LEAD_IN_SECONDS) * bytes_per_second) - 1
+    if size:
+        end = min(end, size - 1)
+
+    if end < start:
+        return None
+    return start, end
+
+
+class SkipTargetPrebuffer:
+    """
+    Reads the part of the stream around a skip target with a ranged request before the user skips, so the server
+    and OS caches are warm and the seek doesn't wait for the server disk.
+    """
+
+    def __init__(self, jellyfin):
+        self.jellyfin = jellyfin
+        self._lock = threading.Lock()
+        # Media source of the last item, all targets of a playback are in the same file
+        self._source_item_id = None
+        self._source = None
+
+    def prebuffer(self, item_id, target_seconds, seconds=None):
+        """
+        Start reading the stream around the target in a background thread
+        :param item_id: the Jellyfin ItemId of the playing item
+        :param target_seconds: the position the player will seek to
+        :param seconds: the amount of seconds to read after the target, defaults to the prebuffer_seconds setting
+        :return: None
+        """
+        if not item_id:
+            return
+
+        if seconds is None:
+            seconds = utils.settings_number('prebuffer_seconds', DEFAULT_PREBUFFER_SECONDS)
+
+        utils.run_threaded(self._prebuffer, kwargs={'item_id': item_id, 'target_seconds': target_seconds,
+                                                    'seconds': seconds})
+
+    def _get_media_source(self, item_id):
+        with self._lock:
+            if item_id == self._source_item_id:
+                return self._source
+
+        item = self.jellyfin.make_request(f"Items/{item_id}?Fields=MediaSources")
+        media_sources = item.get("MediaSources") or [{}]
+        source = (media_sources[0], item.get("RunTimeTicks"))
+
+        with self._lock:
+            self._source_item_id, self._source = item_id, source
+        return source
+
+    def _prebuffer(self, item_id, target_seconds, seconds):
+        try:
+            media_source, runtime_ticks = self._get_media_source(item_id)
+            byte_range = get_byte_range(media_source, runtime_ticks, target_seconds, seconds)
+
+            if byte_range is None or not media_source.get("Id"):
+                LOG.debug("No size or bitrate known for %s, not prebuffering", item_id)
+                return
+
+            api_endpoint = f"Videos/{item_id}/stream?Static=true&MediaSourceId={media_source['Id']}"
+            with metrics.timer("prebuffer_request"):
+                length = self.jellyfin.make_range_request(api_endpoint, *byte_range)
+            metrics.incr("prebuffer_bytes", length)
+            LOG.debug("Prebuffered %s bytes of %s at %.1f seconds", length, item_id, target_seconds)
+        except Exception as error:
+            metrics.incr("prebuffer_errors")
+            LOG.info("Could not prebuffer %s at %.1f seconds: %s", item_id, target_seconds, error)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import threading
+
+import helper.utils as utils
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+# Amount of upcoming episodes to load the media segments for
+DEFAULT_PREFETCH_COUNT = 3
+
+
+class SegmentPrefetcher:
+    """
+    Loads the media segments of the episodes following the playing one in a background thread,
+    so they are already in memory when the next episode starts.
+    """
+
+    def __init__(self, jellyfin, count=DEFAULT_PREFETCH_COUNT):
+        self.jellyfin = jellyfin
+        self.count = count
+        self._last_item_id = None
+        self._lock = threading.Lock()
+
+    def prefetch(self, item_id):
+        """
+        Start prefetching the episodes following the item, unless this item was the last one prefetched for
+        :param item_id: the Jellyfin ItemId of the playing item
+        :return: None
+        """
+        if not item_id or self.count <= 0:
+            return
+
+        with self._lock:
+            if item_id == self._last_item_id:
+                return
+            self._last_item_id = item_id
+
+        utils.run_threaded(self._prefetch, kwargs={'item_id': item_id})
+
+    def _get_next_episode_ids(self, item_id):
+        item = self.jellyfin.make_request(f"Items/{item_id}")
+
+        if item.get("Type") != "Episode" or not item.get("SeriesId"):
+            return []
+
+        episodes = self.jellyfin.make_request(
+            f"Shows/{item['SeriesId']}/Episodes?StartItemId={item_id}&Limit={self.count + 1}&EnableUserData=false"
+        )
+
+        return [episode["Id"] for episode in episodes.get("Items", []) if episode.get("Id") != item_id][:self.count]
+
+    def _prefetch(self, item_id):
+        try:
+            episode_ids = self._get_next_episode_ids(item_id)
+        except Exception as error:
+            LOG.info("Could not find episodes following %s: %s", item_id, error)
+            return
+
+        for episode_id in episode_ids:
+            if self.jellyfin.is_memory_cached(episode_id):
+                continue
+
+            try:
+                self.jellyfin.load_media_segments_into_memory(episode_id)
+            except Exception as error:
+                LOG.info("Could not prefetch media segments for %s: %s", episode_id, error)
+
+        LOG.info("Prefetched media segments for %s episodes following %s", len(episode_ids), item_id)
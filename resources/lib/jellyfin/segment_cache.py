@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import json
+import sqlite3
+import threading
+import time
+
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+# Entries younger than this are served without asking the server
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+# Used when changes are pushed by the Jellyfin websocket, entries are invalidated as soon as they change
+PUSH_INVALIDATION_TTL_SECONDS = 14 * 24 * 60 * 60
+# Maximum amount of items kept on disk, least recently used items are evicted first.
+# Payloads are small, this is enough to hold the segments of a whole library.
+DEFAULT_MAX_ENTRIES = 50000
+# The cache size is checked once every this many stores, so it may exceed the maximum by this much
+EVICT_INTERVAL_PUTS = 500
+# Access times of cache hits are kept in memory and written with the next store, or once this many are pending
+MAX_PENDING_ACCESSES = 100
+
+
+class CacheEntry:
+    def __init__(self, item_id: str, payload: dict, etag: str, fetched_at: float):
+        self.item_id = item_id
+        self.payload = payload
+        self.etag = etag
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, ttl_seconds):
+        return time.time() - self.fetched_at < ttl_seconds
+
+
+class SegmentCache:
+    """
+    Persistent MediaSegments cache keyed by the Jellyfin ItemId.
+    Stores the raw MediaSegments json payload together with the ETag (if the server sent one) and the fetch time,
+    so stale entries can be revalidated instead of downloaded again.
+    """
+
+    def __init__(self, db_path, ttl_seconds=DEFAULT_TTL_SECONDS, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._connection = None
+        self._lock = threading.Lock()
+        # Access times of cache hits not written yet, so reads never commit
+        self._pending_accesses = {}
+        self._puts_since_evict = 0
+
+    def _get_connection(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS segments ("
+                "item_id TEXT PRIMARY KEY, "
+                "payload TEXT NOT NULL, "
+                "etag TEXT, "
+                "fetched_at REAL NOT NULL, "
+                "accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS segments_accessed ON segments (accessed_at)")
+            self._connection.commit()
+        return self._connection
+
+    def get(self, item_id: str):
+        """
+        Get the cached entry for the item and mark it as recently used. The access time is written later,
+        together with the next store.
+        :param item_id: the Jellyfin ItemId
+        :return: CacheEntry or None if the item is not cached
+        """
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute(
+                "SELECT payload, etag, fetched_at FROM segments WHERE item_id = ?", (item_id,)
+            ).fetchone()
+
+            if not row:
+                return None
+
+            self._pending_accesses[item_id] = time.time()
+            if len(self._pending_accesses) >= MAX_PENDING_ACCESSES:
+                self._flush_accesses(connection)
+                connection.commit()
+
+        try:
+            payload = json.loads(row[0])
+        except ValueError:
+            self.delete(item_id)
+            return None
+
+        return CacheEntry(item_id, payload, row[1], row[2])
+
+    def has(self, item_id: str):
+        """
+        Check if the item is cached, without marking it as recently used
+        """
+        with self._lock:
+            row = self._get_connection().execute("SELECT 1 FROM segments WHERE item_id = ?", (item_id,)).fetchone()
+        return row is not None
+
+    def put(self, item_id: str, payload: dict, etag: str = None):
+        """
+        Store the MediaSegments payload of the item, evicting least recently used items if the cache is full
+        :param item_id: the Jellyfin ItemId
+        :param payload: the MediaSegments json response
+        :param etag: the ETag header of the response, if any
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO segments (item_id, payload, etag, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (item_id, json.dumps(payload), etag, now, now)
+            )
+            self._pending_accesses.pop(item_id, None)
+            self._flush_accesses(connection)
+
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= EVICT_INTERVAL_PUTS:
+                self._puts_since_evict = 0
+                self._evict(connection)
+            connection.commit()
+
+    def touch(self, item_id: str):
+        """
+        Mark the cached entry as revalidated (e.g. the server answered 304 Not Modified)
+        :param item_id: the Jellyfin ItemId
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "UPDATE segments SET fetched_at = ?, accessed_at = ? WHERE item_id = ?", (now, now, item_id)
+            )
+            self._pending_accesses.pop(item_id, None)
+            self._flush_accesses(connection)
+            connection.commit()
+
+    def get_stale_item_ids(self, limit):
+        """
+        Get the ids of expired entries, most recently used first
+        :param limit: maximum amount of ids
+        :return: list of ItemIds
+        """
+        with self._lock:
+            connection = self._get_connection()
+            # The order depends on the access times
+            if self._pending_accesses:
+                self._flush_accesses(connection)
+                connection.commit()
+            rows = connection.execute(
+                "SELECT item_id FROM segments WHERE fetched_at < ? ORDER BY accessed_at DESC LIMIT ?",
+                (time.time() - self.ttl_seconds, limit)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, item_id: str):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("DELETE FROM segments WHERE item_id = ?", (item_id,))
+            self._pending_accesses.pop(item_id, None)
+            connection.commit()
+
+    def _flush_accesses(self, connection):
+        if self._pending_accesses:
+            connection.executemany("UPDATE segments SET accessed_at = ? WHERE item_id = ?",
+                                   [(accessed_at, item_id) for item_id, accessed_at in self._pending_accesses.items()])
+            self._pending_accesses.clear()
+
+    def _evict(self, connection):
+        count = connection.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+        overflow = count - self.max_entries
+
+        if overflow > 0:
+            connection.execute(
+                "DELETE FROM segments WHERE item_id IN "
+                "(SELECT item_id FROM segments ORDER BY accessed_at ASC LIMIT ?)", (overflow,)
+            )
+            LOG.info("Evicted %s media segment cache entries", overflow)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._flush_accesses(self._connection)
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
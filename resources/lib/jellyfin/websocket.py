@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+from urllib.parse import urlsplit, urlencode
+
+from helper import LazyLogger
+
+LOG = LazyLogger(__name__)
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+DEFAULT_TIMEOUT_SECONDS = 10
+DEFAULT_KEEP_ALIVE_SECONDS = 30
+# Reconnect delays, doubled after each failed attempt and jittered
+MIN_RECONNECT_SECONDS = 1
+MAX_RECONNECT_SECONDS = 300
+# How often the listener checks whether it should stop
+POLL_SECONDS = 1
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocketConnection:
+    """
+    Minimal RFC 6455 websocket client, enough to receive the text messages of the Jellyfin websocket.
+    Answers pings, reassembles fragmented messages and masks all frames sent.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b""
+        self._fragments = []
+        self._fragment_opcode = None
+
+    @classmethod
+    def connect(cls, url, timeout=DEFAULT_TIMEOUT_SECONDS):
+        """
+        Open a websocket connection
+        :param url: ws:// or wss:// url
+        :param timeout: connect and handshake timeout in seconds
+        :return: WebSocketConnection
+        """
+        parts = urlsplit(url)
+        secure = parts.scheme.lower() == "wss"
+        host = parts.hostname
+        port = parts.port or (443 if secure else 80)
+
+        sock = socket.create_connection((host, port), timeout=timeout)
+        try:
+            if secure:
+                sock = ssl.create_default_context().wrap_socket(sock, server_hostname=host)
+
+            connection = cls(sock)
+            connection._handshake(parts, host, port)
+            return connection
+        except Exception:
+            sock.close()
+            raise
+
+    def _handshake(self, parts, host, port):
+        key = base64.b64encode(os.urandom(16)).decode("ascii")
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        request = (f"GET {path} HTTP/1.1\r\n"
+                   f"Host: {host}:{port}\r\n"
+                   "Upgrade: websocket\r\n"
+                   "Connection: Upgrade\r\n"
+                   f"Sec-WebSocket-Key: {key}\r\n"
+                   "Sec-WebSocket-Version: 13\r\n\r\n")
+        self.sock.sendall(request.encode("ascii"))
+
+        while b"\r\n\r\n" not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                raise WebSocketClosed("Connection closed during handshake")
+            self._buffer += data
+
+        head, self._buffer = self._buffer.split(b"\r\n\r\n", 1)
+        lines = head.decode("iso-8859-1").split("\r\n")
+        status = lines[0].split(" ", 2)
+
+        if len(status) < 2 or status[1] != "101":
+            raise WebSocketClosed(f"Handshake failed: {lines[0]}")
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        expected = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode("ascii")).digest()).decode("ascii")
+        if headers.get("sec-websocket-accept") != expected:
+            raise WebSocketClosed("Handshake failed: invalid Sec-WebSocket-Accept")
+
+    def send(self, payload, opcode=OPCODE_TEXT):
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        length = len(payload)
+        header = bytes([0x80 | opcode])
+        if length < 126:
+            header += bytes([0x80 | length])
+        elif length < 65536:
+            header += bytes([0x80 | 126]) + struct.pack("!H", length)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack("!Q", length)
+
+        mask = os.urandom(4)
+        masked = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        self.sock.sendall(header + mask + masked)
+
+    def _parse_frame(self):
+        """
+        Take one complete frame from the buffer
+        :return: tuple of (fin, opcode, payload) or None if the buffer holds no complete frame yet
+        """
+        buffer = self._buffer
+        if len(buffer) < 2:
+            return None
+
+        fin = bool(buffer[0] & 0x80)
+        opcode = buffer[0] & 0x0F
+        masked = bool(buffer[1] & 0x80)
+        length = buffer[1] & 0x7F
+        offset = 2
+
+        if length == 126:
+            if len(buffer) < offset + 2:
+                return None
+            length = struct.unpack("!H", buffer[offset:offset + 2])[0]
+            offset += 2
+        elif length == 127:
+            if len(buffer) < offset + 8:
+                return None
+            length = struct.unpack("!Q", buffer[offset:offset + 8])[0]
+            offset += 8
+
+        mask = None
+        if masked:
+            if len(buffer) < offset + 4:
+                return None
+            mask = buffer[offset:offset + 4]
+            offset += 4
+
+        if len(buffer) < offset + length:
+            return None
+
+        payload = buffer[offset:offset + length]
+        self._buffer = buffer[offset + length:]
+
+        if mask:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+        return fin, opcode, payload
+
+    def recv_message(self, timeout=None):
+        """
+        Receive the next text or binary message. Partially received frames are kept when the timeout expires.
+        :param timeout: timeout in seconds
+        :return: str for text messages, bytes for binary messages
+        :raises socket.timeout: if no complete message arrived in time
+        :raises WebSocketClosed: if the server closed the connection
+        """
+        self.sock.settimeout(timeout)
+
+        while True:
+            frame = self._parse_frame()
+
+            if frame is None:
+                data = self.sock.recv(4096)
+                if not data:
+                    raise WebSocketClosed("Connection closed")
+                self._buffer += data
+                continue
+
+            fin, opcode, payload = frame
+
+            if opcode == OPCODE_PING:
+                self.send(payload, OPCODE_PONG)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode == OPCODE_CLOSE:
+                try:
+                    self.send(payload[:2], OPCODE_CLOSE)
+                except socket.error:
+                    pass
+                raise WebSocketClosed("Closed by server")
+
+            if opcode != OPCODE_CONTINUATION:
+                self._fragment_opcode = opcode
+                self._fragments = []
+            self._fragments.append(payload)
+
+            if not fin:
+                continue
+
+            message = b"".join(self._fragments)
+            self._fragments = []
+            return message.decode("utf-8") if self._fragment_opcode == OPCODE_TEXT else message
+
+    def close(self):
+        try:
+            self.send(b"", OPCODE_CLOSE)
+        except socket.error:
+            pass
+        finally:
+            self.sock.close()
+
+
+def get_jellyfin_websocket_url(server):
+    """
+    Get the websocket url of a Jellyfin server
+    :param server: the JellyfinServer
+    :return: ws:// or wss:// url
+    """
+    parts = urlsplit(server.address)
+    scheme = "wss" if parts.scheme.lower() == "https" else "ws"
+    query = urlencode({"api_key": server.access_token, "deviceId": "service.jellyskip"})
+    return f"{scheme}://{parts.netloc}{parts.path.rstrip('/')}/socket?{query}"
+
+
+class LibraryChangeListener:
+    """
+    Listens to LibraryChanged messages of the Jellyfin websocket in a background thread and reports the ids of
+    updated and removed items. Reconnects with a jittered exponential backoff.
+    The ids are reported from a worker thread, so handling a large burst of changes never delays keep alives.
+    Changes arriving while the worker is busy are collected and reported together in its next run.
+
+    :param url_provider: callable returning the websocket url to connect to, called on every (re)connect
+    :param on_items_changed: callable receiving the list of changed ItemIds
+    """
+
+    def __init__(self, url_provider, on_items_changed):
+        self.url_provider = url_provider
+        self.on_items_changed = on_items_changed
+        self._stop_event = threading.Event()
+        self._thread = None
+        # Changed ids not reported yet, a dict to keep the order of the messages
+        self._pending_item_ids = {}
+        self._pending_lock = threading.Lock()
+        self._worker_running = False
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="JellySkipWebSocket")
+        # Daemon threads may not work in Kodi, but enable it anyway
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        thread, self._thread = self._thread, None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def is_running(self):
+        return self._thread is not None
+
+    def _run(self):
+        delay = MIN_RECONNECT_SECONDS
+
+        while not self._stop_event.is_set():
+            connection = None
+            try:
+                connection = WebSocketConnection.connect(self.url_provider())
+                LOG.info("Connected to the Jellyfin websocket")
+                delay = MIN_RECONNECT_SECONDS
+                self._listen(connection)
+            except Exception as error:
+                LOG.info("Jellyfin websocket disconnected: %s", error)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+            if self._stop_event.is_set():
+                break
+
+            self._stop_event.wait(random.uniform(delay / 2, delay * 1.5))
+            delay = min(delay * 2, MAX_RECONNECT_SECONDS)
+
+    def _listen(self, connection):
+        keep_alive = DEFAULT_KEEP_ALIVE_SECONDS
+        last_keep_alive = time.monotonic()
+
+        while not self._stop_event.is_set():
+            if time.monotonic() - last_keep_alive >= keep_alive:
+                connection.send(json.dumps({"MessageType": "KeepAlive"}))
+                last_keep_alive = time.monotonic()
+
+            try:
+                message = connection.recv_message(timeout=POLL_SECONDS)
+            except socket.timeout:
+                continue
+
+            try:
+                message = json.loads(message)
+            except ValueError:
+                continue
+
+            message_type = message.get("MessageType")
+            data = message.get("Data") or {}
+
+            if message_type == "ForceKeepAlive" and isinstance(data, (int, float)) and data > 0:
+                # The server expects a keep alive message within this interval
+                keep_alive = data / 2
+            elif message_type == "LibraryChanged":
+                item_ids = data.get("ItemsUpdated", []) + data.get("ItemsRemoved", [])
+                if item_ids:
+                    LOG.info("Library changed, %s items updated or removed", len(item_ids))
+                    self._report(item_ids)
+
+    def _report(self, item_ids):
+        with self._pending_lock:
+            self._pending_item_ids.update(dict.fromkeys(item_ids))
+            if self._worker_running:
+                return
+            self._worker_running = True
+
+        worker = threading.Thread(target=self._run_worker, name="JellySkipLibraryChanges")
+        worker.daemon = True
+        worker.start()
+
+    def _run_worker(self):
+        while True:
+            with self._pending_lock:
+                if not self._pending_item_ids or self._stop_event.is_set():
+                    self._worker_running = False
+                    return
+                item_ids = list(self._pending_item_ids)
+                self._pending_item_ids = {}
+
+            try:
+                self.on_items_changed(item_ids)
+            except Exception as error:
+                LOG.exception(error)
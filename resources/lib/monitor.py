@@ -1,20 +1,39 @@
-import xbmc, xbmcaddon
+import json
+import queue
+import threading
+import time
+
+import xbmc
 
 from helper import LazyLogger
 import player
 import helper.utils as utils
+from playback_clock import PlaybackClock
 
-from jellyfin.jellyfin_grabber import JellyfinHack
-from skip_dialogue import SkipSegmentDialogue
-from dialogue_handler import dialogue_handler
-
-addonInfo = xbmcaddon.Addon().getAddonInfo
-addonPath = utils.translate_path(addonInfo('path'))
-
-jf_hack = JellyfinHack()
+from helper.scheduler import Scheduler
+from helper.metrics import metrics
 
 LOG = LazyLogger(__name__)
 
+# Maximum time to wait for plugin.video.jellyfin to tell us the ItemId of the playing item
+ITEMID_TIMEOUT_SECONDS = 30
+# Delay of the first library sync, so it does not compete with Kodi startup
+STARTUP_SYNC_DELAY_SECONDS = 30
+# Interval between library syncs (or updates of the path to ItemId index only, if syncing is disabled)
+LIBRARY_SYNC_SECONDS = 6 * 60 * 60
+# Minimum time since the last sync before an idle (screensaver) sync is started
+IDLE_SYNC_MIN_SECONDS = 60 * 60
+# Interval between metrics summaries
+METRICS_INTERVAL_SECONDS = 5 * 60
+# Player events within this window are coalesced into one re-evaluation of the upcoming segment
+DEFAULT_EVENT_DEBOUNCE_SECONDS = 0.3
+# A continuous burst of events (e.g. scrubbing) is still evaluated at least this often
+MAX_EVENT_DEBOUNCE_SECONDS = 1
+# Wait of the main thread between runs of the queued window actions, while the dialogue is shown or about to be
+# shown, and otherwise
+UI_POLL_SECONDS = 0.05
+IDLE_POLL_SECONDS = 1
+
 
 class JellySkipMonitor(xbmc.Monitor):
 
@@ -22,41 +41,242 @@ class JellySkipMonitor(xbmc.Monitor):
     def __init__(self):
         xbmc.Monitor.__init__(self)
         self.player = player.JellySkipPlayer(self)
+        self.scheduler = Scheduler()
+        self.clock = PlaybackClock(self.scheduler, self.player,
+                                   on_segment_enter=self._on_segment_enter, on_segment_exit=self._on_segment_exit)
+        # The Jellyfin client and the dialogue stack are only loaded when first needed, to keep startup fast
+        self._jellyfin = None
+        self._dialogue_handler = None
+        self._load_lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._fetch_requested = False
+        self._fetch_running = False
+        self.sync_task = None
+        self.metrics_task = None
+        self.tracking_task = None
+        self._tracking_lock = threading.Lock()
+        self._tracking_burst_started = None
+        self.last_sync = None
+        # Window actions for the main thread, see run_on_main_thread
+        self._ui_tasks = queue.Queue()
         LOG.info('Init monitor')
 
     def start(self, **kwargs):
         LOG.info('Starting JellySkipMonitor')
+        self.scheduler.start()
+        self.sync_task = self.scheduler.schedule(STARTUP_SYNC_DELAY_SECONDS, self._sync_library, run_in_thread=True)
+        self.metrics_task = self.scheduler.schedule(METRICS_INTERVAL_SECONDS, self._publish_metrics)
         while not self.abortRequested():
-            self.waitForAbort(1)
+            self._run_ui_tasks()
+            self.waitForAbort(UI_POLL_SECONDS if self._expects_ui_tasks() else IDLE_POLL_SECONDS)
 
         self.stop()
 
+    def run_on_main_thread(self, target, *args):
+        """
+        Queue a window action for the main thread. Kodi runs the callbacks of a window (onInit, onClick, onAction)
+        only on the thread that created it, and only while that thread waits in waitForAbort, so windows are
+        created, shown and closed by the main thread in start().
+        :param target: the callable to run
+        :param args: positional arguments for the target
+        :return: None
+        """
+        self._ui_tasks.put((target, args))
+
+    def _expects_ui_tasks(self):
+        if not self._ui_tasks.empty() or self._fetch_running:
+            return True
+        # A tracking run may arm a segment the playback is already in
+        if self.tracking_task is not None and self.tracking_task.is_pending():
+            return True
+        return self._dialogue_handler is not None and self._dialogue_handler.expects_window_actions()
+
+    def _run_ui_tasks(self):
+        while True:
+            try:
+                target, args = self._ui_tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                target(*args)
+            except Exception as error:
+                LOG.exception(error)
+
+    def get_jellyfin(self):
+        """
+        Get the Jellyfin client, importing and creating it on first use
+        :return: JellyfinHack
+        """
+        with self._load_lock:
+            if self._jellyfin is None:
+                start = time.perf_counter()
+                from jellyfin.jellyfin_grabber import JellyfinHack
+                self._jellyfin = JellyfinHack(on_segments_changed=self.request_tracking)
+                LOG.info("Loaded Jellyfin client in %.1f ms", (time.perf_counter() - start) * 1000)
+            return self._jellyfin
+
+    def get_dialogue_handler(self):
+        """
+        Get the dialogue handler, importing the dialogue window stack on first use
+        :return: DialogueHandler
+        """
+        with self._load_lock:
+            if self._dialogue_handler is None:
+                start = time.perf_counter()
+                from dialogue_handler import dialogue_handler
+                dialogue_handler.set_scheduler(self.scheduler)
+                dialogue_handler.set_clock(self.clock)
+                dialogue_handler.set_prebuffer(self._prebuffer)
+                dialogue_handler.set_ui_runner(self.run_on_main_thread)
+                self._dialogue_handler = dialogue_handler
+                LOG.info("Loaded dialogue handler in %.1f ms", (time.perf_counter() - start) * 1000)
+            return self._dialogue_handler
+
+    def _sync_library(self):
+        self.last_sync = time.monotonic()
+        jf_hack = self.get_jellyfin()
+        jf_hack.start_change_listener()
+
+        try:
+            if utils.settings('library_sync.bool') is not False:
+                jf_hack.sync_library()
+            else:
+                jf_hack.refresh_path_index()
+        except Exception as error:
+            LOG.info("Could not sync library: %s", error)
+
+        if not self.abortRequested():
+            self.sync_task.reschedule(LIBRARY_SYNC_SECONDS)
+
+    def _publish_metrics(self):
+        metrics.publish()
+        self.metrics_task.reschedule(METRICS_INTERVAL_SECONDS)
+
+    def onSettingsChanged(self):
+        from helper.loghandler import refresh_log_level
+        refresh_log_level()
+        utils.clear_settings_cache()
+
+    def onScreensaverActivated(self):
+        # Kodi is idle, a good moment to sync if the last sync is a while ago
+        if self.player.isPlayingVideo() or self.sync_task is None:
+            return
+
+        if self.last_sync is None or time.monotonic() - self.last_sync > IDLE_SYNC_MIN_SECONDS:
+            LOG.info('JellySkipMonitor: screensaver activated, syncing library')
+            self.sync_task.reschedule(0)
+
+    def _prebuffer(self, target_seconds):
+        jf_hack = self.get_jellyfin()
+        jf_hack.prebuffer.prebuffer(jf_hack.jellyfin_itemid, target_seconds)
+
+    def _on_segment_enter(self, item, position):
+        self.get_dialogue_handler().on_segment_enter(item, position)
+
+    def _on_segment_exit(self, item, position):
+        self.get_dialogue_handler().on_segment_exit(item, position)
+
+    def _event_handler_player_speed(self, data=None, **_kwargs):
+        # Paused, resumed or fast forwarding, the clock rescales its pending samples
+        try:
+            speed = json.loads(data)["player"]["speed"]
+        except (TypeError, ValueError, KeyError):
+            LOG.debug('JellySkipMonitor: no speed in player event')
+            return
+
+        LOG.debug("JellySkipMonitor: player speed %s", speed)
+        self.clock.set_speed(speed)
+
+    def _event_handler_player_resume(self, **kwargs):
+        self._event_handler_player_speed(**kwargs)
+        self._event_handler_player_change_playback(**kwargs)
+
     def _event_handler_player_change_playback(self, **_kwargs):
-        LOG.info('JellySkipMonitor: player general event')
+        LOG.debug('JellySkipMonitor: player general event')
+        # The position jumped, don't extrapolate from the last sample
+        self.clock.invalidate()
+        self.request_tracking()
+
+    def request_tracking(self):
+        """
+        Re-evaluate the upcoming segment once a burst of player events has settled.
+        Every event within the debounce window pushes the evaluation back, up to MAX_EVENT_DEBOUNCE_SECONDS after
+        the first event of the burst, so the evaluation always uses the latest player position.
+        :return: None
+        """
+        metrics.incr("player_events")
+        debounce = utils.settings_number('event_debounce', DEFAULT_EVENT_DEBOUNCE_SECONDS, cached=True)
+
+        with self._tracking_lock:
+            now = time.monotonic()
+            if self._tracking_burst_started is None:
+                self._tracking_burst_started = now
+            delay = max(0, min(debounce, self._tracking_burst_started + MAX_EVENT_DEBOUNCE_SECONDS - now))
+
+            # Runs on the scheduler thread, start_tracking only schedules and never blocks
+            if self.tracking_task is None:
+                self.tracking_task = self.scheduler.schedule(delay, self._run_tracking)
+            else:
+                self.tracking_task.reschedule(delay)
+
+    def cancel_tracking(self):
+        with self._tracking_lock:
+            self._tracking_burst_started = None
+            if self.tracking_task is not None:
+                self.tracking_task.cancel()
+
+    def _run_tracking(self):
+        with self._tracking_lock:
+            self._tracking_burst_started = None
+
+        metrics.incr("tracking_runs")
+        # Leave the segments playback left and enter the ones it jumped into before re-evaluating
+        self.clock.sync()
         self.start_tracking()
 
     def _event_handler_player_stop(self, **_kwargs):
         LOG.info('JellySkipMonitor: player stop event')
+        self.cancel_tracking()
+        self.clock.stop()
+        jf_hack = self.get_jellyfin()
+        dialogue_handler = self.get_dialogue_handler()
         jf_hack.reset_itemid()
         dialogue_handler.cancel_scheduled()
+        dialogue_handler.reset_session()
         LOG.info('JellySkipMonitor: reset itemid')
+        metrics.publish()
 
     def _event_handler_player_start(self, **_kwargs):
         LOG.info('JellySkipMonitor: player start event')
+        self.cancel_tracking()
+        self.clock.stop()
+        jf_hack = self.get_jellyfin()
+        dialogue_handler = self.get_dialogue_handler()
         jf_hack.reset_itemid()
+        playing_file = self.player.get_playing_file()
+        jf_hack.set_playing_file(playing_file)
         dialogue_handler.cancel_scheduled()
+        dialogue_handler.reset_session()
+
+        # UserDataChanged is only the fallback, it arrives late or never for native path playback
+        if jf_hack.resolve_itemid(playing_file):
+            self.fetch_segments_async()
 
     def _event_handler_jellyskip_dialogue_closed(self, **_kwargs):
         LOG.info('JellySkipMonitor: player dialogue closed event')
         # User closed dialogue, now we want to start tracking only the next upcoming segment
         self.start_tracking(only_upcoming=True)
 
+    def _event_handler_jellyfin_userdatachanged(self, **kwargs):
+        self.get_jellyfin().event_handler_jellyfin_userdatachanged(self, **kwargs)
+
     EVENTS_MAP = {
-        'Other.UserDataChanged': jf_hack.event_handler_jellyfin_userdatachanged,
+        'Other.UserDataChanged': _event_handler_jellyfin_userdatachanged,
         'Other.Jellyskip.DialogueClosed': _event_handler_jellyskip_dialogue_closed,
-        # 'Player.OnPause': _event_handler_player_change_playback,
-        'Player.OnResume': _event_handler_player_change_playback,
-        # 'Player.OnSpeedChanged': _event_handler_player_change_playback,
+        'Player.OnPause': _event_handler_player_speed,
+        'Player.OnResume': _event_handler_player_resume,
+        'Player.OnSpeedChanged': _event_handler_player_speed,
         'Player.OnSeek': _event_handler_player_change_playback,
         'Player.OnStop': _event_handler_player_stop,
         'Player.OnPlay': _event_handler_player_start,
@@ -65,6 +285,13 @@ class JellySkipMonitor(xbmc.Monitor):
 
     def stop(self):
         LOG.info('Stopping JellySkipMonitor')
+        if self._jellyfin is not None:
+            # Cancel any fetch still waiting for an itemid
+            self._jellyfin.reset_itemid()
+            self._jellyfin.stop_change_listener()
+        self.scheduler.stop()
+        if self._jellyfin is not None:
+            self._jellyfin.close()
 
     def onNotification(self, sender, method, data=None):
         """Handler for Kodi events and data transfer from plugins"""
@@ -76,50 +303,95 @@ class JellySkipMonitor(xbmc.Monitor):
         if not handler:
             return
 
-        LOG.info(f"Notification: sender={sender}, method={method}, data={data}")
+        LOG.debug("Notification: sender=%s, method=%s, data=%s", sender, method, data)
 
         handler(self, sender=sender, data=data)
 
         if method == 'Other.UserDataChanged':
-            while not jf_hack.has_itemid():
-                self.waitForAbort(1)
+            self.fetch_segments_async()
+
+    def fetch_segments_async(self):
+        """
+        Fetch the media segments of the playing item in a worker thread, so Kodi's notification thread never blocks.
+        Requests made while a fetch is running are coalesced into one more run of the worker.
+        :return: None
+        """
+        with self._fetch_lock:
+            self._fetch_requested = True
+            if self._fetch_running:
+                return
+            self._fetch_running = True
 
-            LOG.info('JellySkipMonitor: getting media segments')
+        utils.run_threaded(self._fetch_segments_worker)
 
-            if not self.player.isPlayingVideo() or not jf_hack.has_itemid():
-                return
+    def _fetch_segments_worker(self):
+        while True:
+            with self._fetch_lock:
+                if not self._fetch_requested or self.abortRequested():
+                    self._fetch_running = False
+                    return
+                self._fetch_requested = False
+
+            try:
+                self._fetch_segments()
+            except Exception as error:
+                LOG.exception(error)
 
-            jf_hack._fetch_media_segments()
-            self.start_tracking()
+    def _fetch_segments(self):
+        jf_hack = self.get_jellyfin()
+        item_id = jf_hack.wait_for_itemid(ITEMID_TIMEOUT_SECONDS)
+
+        if not item_id:
+            LOG.info('JellySkipMonitor: no itemid, not getting media segments')
+            return
+
+        LOG.info('JellySkipMonitor: getting media segments')
 
-    def start_tracking(self, only_upcoming=False):
         if not self.player.isPlayingVideo():
-            LOG.info('Not playing video')
             return
 
-        time_seconds = self.player.getTime()
+        jf_hack.get_media_segments()
+        self.start_tracking(fetch_missing=False)
+
+    def start_tracking(self, only_upcoming=False, fetch_missing=True):
+        if not self.player.isPlayingVideo():
+            LOG.debug('Not playing video')
+            return
+
+        time_seconds = self.clock.get_time()
         duration_seconds = self.player.getTotalTime()
+        jf_hack = self.get_jellyfin()
+        dialogue_handler = self.get_dialogue_handler()
+
+        media_segments = jf_hack.get_media_segments(fetch=False)
 
-        media_segments = jf_hack.get_media_segments()
+        if not media_segments and fetch_missing and jf_hack.has_itemid():
+            # Segments are not loaded yet, tracking starts again once the worker has fetched them
+            LOG.debug('Media segments not loaded yet')
+            self.fetch_segments_async()
+            return
 
         # No media segments
         if not media_segments:
-            LOG.info('No media segments')
+            LOG.debug('No media segments')
+            self.clock.stop()
             # Close any open dialogues, if any
             dialogue_handler.close_gui()
             return
 
-        LOG.info(f"Start tracking: time={time_seconds}, duration={duration_seconds}")
+        LOG.debug("Start tracking: time=%s, duration=%s", time_seconds, duration_seconds)
+        media_segments = dialogue_handler.get_skip_ranges(media_segments)
+        self.clock.set_segments(media_segments.items)
 
         next_item = media_segments.get_next_item(time_seconds, only_upcoming)
 
         if not next_item:
             # Close any open dialogues, if any
             dialogue_handler.close_gui()
-            LOG.info('Stopping all dialogue, because no next item')
+            LOG.debug('Stopping all dialogue, because no next item')
             return
 
-        LOG.info(f"Next item: {next_item}")
+        LOG.debug("Next item: %s", next_item)
 
         dialogue_handler.schedule_skip_gui(next_item, time_seconds)
 
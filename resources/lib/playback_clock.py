@@ -0,0 +1,238 @@
+import threading
+import time
+from bisect import bisect_right
+
+import xbmc
+
+from helper import LazyLogger
+import helper.utils as utils
+from helper.metrics import metrics
+
+LOG = LazyLogger(__name__)
+
+# Default interval between reads of the player time, overridden by the position_sample_interval setting
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 1.0
+# Lower bound of the sample interval, so a bad setting never makes the clock spin on the scheduler thread
+MIN_SAMPLE_INTERVAL_SECONDS = 0.1
+# Added to the time until the next segment boundary, so the sample after waking up lies past the boundary
+BOUNDARY_MARGIN_SECONDS = 0.01
+# Interval between reads of the player time while waiting for a seek to play
+SEEK_POLL_SECONDS = 0.05
+# Give up measuring a seek after this time, e.g. when playback was stopped
+SEEK_TIMEOUT_SECONDS = 15
+
+
+class PlaybackClock:
+    """
+    Single source of the playback position. The player time is sampled at a fixed rate and extrapolated in between
+    using the playback speed, so looking up the position doesn't go to the player.
+    Entering and leaving the segments of the playing item is reported through callbacks, raised at the segment
+    boundaries on the scheduler thread.
+
+    :param scheduler: the helper.scheduler.Scheduler the samples run on
+    :param player: the xbmc.Player to sample
+    :param on_segment_enter: callable receiving (item, position) when playback enters a segment
+    :param on_segment_exit: callable receiving (item, position) when playback leaves a segment
+    """
+
+    def __init__(self, scheduler, player=None, on_segment_enter=None, on_segment_exit=None):
+        self.scheduler = scheduler
+        self.player = player or xbmc.Player()
+        self.on_segment_enter = on_segment_enter
+        self.on_segment_exit = on_segment_exit
+        self.sample_interval = DEFAULT_SAMPLE_INTERVAL_SECONDS
+        self._lock = threading.RLock()
+        self._position = None
+        self._sampled_at = None
+        self._speed = 1.0
+        self._segments = []
+        self._boundaries = []
+        self._active = set()
+        self._task = None
+        self._seek_task = None
+
+    def get_time(self):
+        """
+        Get the current playback position, sampling the player if the last sample is too old
+        :return: position in seconds
+        """
+        with self._lock:
+            if self._position is None or time.monotonic() - self._sampled_at >= self.sample_interval:
+                self._sample()
+            return self._extrapolate()
+
+    def get_speed(self):
+        return self._speed
+
+    def set_speed(self, speed):
+        """
+        Change the playback speed, e.g. 0 when paused or 2 when fast forwarding.
+        Pending boundary samples are rescaled, and suspended while paused.
+        :param speed: the playback speed, negative when rewinding
+        :return: None
+        """
+        with self._lock:
+            if self._position is not None:
+                # Keep the position reached so far, only the time after now runs at the new speed
+                now = time.monotonic()
+                self._position = self._extrapolate(now)
+                self._sampled_at = now
+
+            self._speed = speed
+            if self._segments:
+                self._schedule_tick()
+
+    def invalidate(self):
+        """
+        Forget the last sample, e.g. after a seek, so the next position is read from the player
+        :return: None
+        """
+        with self._lock:
+            self._position = None
+
+    def set_segments(self, segments):
+        """
+        Track the segments of the playing item. Segments the playback is already in count as entered,
+        without raising events for them.
+        :param segments: list of MediaSegmentItem
+        :return: None
+        """
+        with self._lock:
+            if segments is self._segments:
+                return
+
+            self.sample_interval = max(MIN_SAMPLE_INTERVAL_SECONDS,
+                                       utils.settings_number('position_sample_interval',
+                                                             DEFAULT_SAMPLE_INTERVAL_SECONDS))
+            self._segments = segments
+            self._boundaries = sorted({boundary for item in segments
+                                       for boundary in (item.get_start_seconds(), item.get_end_seconds())})
+            self._sample()
+            self._active = self._get_active(self._position)
+            self._schedule_tick()
+
+    def sync(self):
+        """
+        Sample the player now and raise the events of segments entered or left since the last sample
+        :return: None
+        """
+        self._tick()
+
+    def stop(self):
+        """
+        Stop tracking, e.g. when playback stops
+        :return: None
+        """
+        with self._lock:
+            if self._task is not None:
+                self._task.cancel()
+            self._segments = []
+            self._boundaries = []
+            self._active = set()
+            self._position = None
+            self._speed = 1.0
+
+    def measure_seek(self, target_seconds, name="seek_to_playback"):
+        """
+        Record the time until playback runs past the target of a seek, which is when the first frames after the
+        seek are shown. The player is polled on the scheduler thread.
+        :param target_seconds: the position seeked to
+        :param name: the metrics timing to record
+        :return: None
+        """
+        self.invalidate()
+        if self._seek_task is not None:
+            self._seek_task.cancel()
+        self._seek_task = self.scheduler.schedule(SEEK_POLL_SECONDS, self._poll_seek,
+                                                  args=(target_seconds, name, time.monotonic()))
+
+    def _poll_seek(self, target_seconds, name, started):
+        try:
+            position = self.player.getTime()
+        except Exception as error:
+            LOG.debug("Stopped measuring the seek to %.1f: %s", target_seconds, error)
+            return
+
+        elapsed = time.monotonic() - started
+        if position > target_seconds + SEEK_POLL_SECONDS:
+            metrics.record(name, elapsed)
+        elif elapsed < SEEK_TIMEOUT_SECONDS:
+            self._seek_task.reschedule(SEEK_POLL_SECONDS)
+
+    def _sample(self):
+        try:
+            position = self.player.getTime()
+        except Exception as error:
+            LOG.debug("Could not read the player time: %s", error)
+            return
+
+        now = time.monotonic()
+        if self._position is not None:
+            # How far the extrapolated position was off
+            metrics.record("clock_drift", abs(self._extrapolate(now) - position))
+        metrics.incr("clock_samples")
+
+        self._position = position
+        self._sampled_at = now
+
+    def _extrapolate(self, now=None):
+        if self._position is None:
+            return 0.0
+        return self._position + ((now or time.monotonic()) - self._sampled_at) * self._speed
+
+    def _get_active(self, position):
+        return {item for item in self._segments if item.get_start_seconds() <= position < item.get_end_seconds()}
+
+    def _tick(self):
+        with self._lock:
+            if not self._segments:
+                return
+
+            self._sample()
+            position = self._extrapolate()
+            active = self._get_active(position)
+            exited = self._active - active
+            entered = active - self._active
+            self._active = active
+            self._schedule_tick()
+
+        # Callbacks run without the lock, they may read the position again
+        for item in sorted(exited, key=lambda segment: segment.get_start_seconds()):
+            self._notify(self.on_segment_exit, item, position)
+        for item in sorted(entered, key=lambda segment: segment.get_start_seconds()):
+            self._notify(self.on_segment_enter, item, position)
+
+    def _schedule_tick(self):
+        """
+        Schedule the next sample at the next segment boundary, or earlier to correct the extrapolation.
+        Nothing is scheduled when no boundary lies ahead or the playback is paused.
+        While rewinding, boundaries are found by sampling at the regular interval.
+        """
+        position = self._extrapolate()
+        index = bisect_right(self._boundaries, position)
+
+        if self._speed == 0 or (self._speed > 0 and index >= len(self._boundaries)):
+            if self._task is not None:
+                self._task.cancel()
+            return
+
+        if self._speed > 0:
+            delay = min(self.sample_interval,
+                        (self._boundaries[index] - position) / self._speed + BOUNDARY_MARGIN_SECONDS)
+        else:
+            delay = self.sample_interval
+
+        if self._task is None:
+            self._task = self.scheduler.schedule(delay, self._tick)
+        else:
+            self._task.reschedule(delay)
+
+    @staticmethod
+    def _notify(callback, item, position):
+        if callback is None:
+            return
+
+        try:
+            callback(item, position)
+        except Exception as error:
+            LOG.exception(error)
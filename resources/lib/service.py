@@ -1,3 +1,7 @@
+import time
+
+_start = time.perf_counter()
+
 from helper import LazyLogger
 from monitor import JellySkipMonitor
 
@@ -5,5 +9,7 @@ LOG = LazyLogger(__name__)
 
 LOG.info("Loading service.py")
 
-JellySkipMonitor().start()
-
+monitor = JellySkipMonitor()
+# Only the monitor loop is loaded at boot, keep an eye on this to catch startup regressions
+LOG.info("Service started in %.1f ms", (time.perf_counter() - _start) * 1000)
+monitor.start()
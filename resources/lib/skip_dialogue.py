@@ -1,7 +1,6 @@
-import xbmcgui, xbmc
+import xbmcgui
 from xbmcgui import ACTION_NAV_BACK, ACTION_PREVIOUS_MENU, ACTION_STOP
 
-import helper.utils as utils
 from helper import LazyLogger
 
 OK_BUTTON = 2101
@@ -15,44 +14,80 @@ CENTER_X = 2
 MIN_REMAINING_SECONDS = 5
 LOG = LazyLogger(__name__)
 
+
+def get_seek_target(total_time, seek_time_seconds):
+    """
+    Get the position a skip seeks to
+    :param total_time: the duration of the playing item in seconds
+    :param seek_time_seconds: the segment end in seconds
+    :return: position in seconds
+    """
+    # We don't want to skip to the end of the video (give other addons time to play, like nextup service)
+    if total_time - seek_time_seconds < MIN_REMAINING_SECONDS:
+        return total_time - MIN_REMAINING_SECONDS
+    return seek_time_seconds
+
+
+def seek_past_segment(player, seek_time_seconds):
+    """
+    Seek the player to the end of a segment
+    :param player: the xbmc.Player to seek
+    :param seek_time_seconds: the segment end in seconds
+    :return: the position seeked to in seconds
+    """
+    target_seconds = get_seek_target(player.getTotalTime(), seek_time_seconds)
+    player.seekTime(target_seconds)
+    return target_seconds
+
+
 class SkipSegmentDialogue(xbmcgui.WindowXMLDialog):
+    """
+    Modeless skip button. The window is built once per playback session and shown again for every segment,
+    with its label and seek target updated in place. It is closed by the DialogueHandler when playback leaves
+    the segment.
+    """
 
-    def __init__(self, xmlFile, resourcePath, seek_time_seconds, segment_type):
+    def __init__(self, xmlFile, resourcePath, player, seek_time_seconds=None, segment_type=None, on_skip=None):
         self.seek_time_seconds = seek_time_seconds
         self.segment_type = segment_type
-        self.player = xbmc.Player()
+        self.visible = False
+        self.player = player
+        # Callable receiving the segment end when the button is clicked, seeks the player directly if not set
+        self.on_skip = on_skip
 
     def onInit(self):
+        self.update_label()
+
+    def update_label(self):
         skip_label = 'Skip ' + str(self.segment_type)
         skip_button = self.getControl(OK_BUTTON)
         skip_button.setLabel(skip_label)
-        self.schedule_close_action()
-
-    def get_seconds_till_segment_end(self):
-        return self.seek_time_seconds - self.player.getTime()
 
-    def schedule_close_action(self):
+    def show_segment(self, seek_time_seconds, segment_type):
         """
-        Schedule the dialog to close automatically when the segment ends.
+        Show the dialog for a segment, without blocking
+        :param seek_time_seconds: the segment end to seek to when the button is clicked
+        :param segment_type: the segment type name shown on the button
         :return: None
         """
+        self.seek_time_seconds = seek_time_seconds
+        self.segment_type = segment_type
 
-        seconds_till_segment_end = self.get_seconds_till_segment_end()
-
-        if seconds_till_segment_end > 0:
-            utils.run_threaded(self.on_automatic_close, delay=seconds_till_segment_end, kwargs={})
+        if self.visible:
+            # Already shown for another segment, onInit is not called again
+            self.update_label()
+        else:
+            self.visible = True
+            self.show()
 
-    def on_automatic_close(self):
+    def close(self):
         """
-        Close the dialog automatically. This is called by the scheduled thread.
+        Hide the dialog, it can be shown again with show_segment
         :return: None
         """
 
-        self.close()
-
-        LOG.info("JellySkip: Auto closing dialogue")
-        sender = "service.jellyskip"
-        xbmc.executebuiltin("NotifyAll(%s, %s, %s)" % (sender, "Jellyskip.DialogueClosed", {}))
+        self.visible = False
+        xbmcgui.WindowXMLDialog.close(self)
 
     def onAction(self, action):
         if action in (ACTION_NAV_BACK, ACTION_PREVIOUS_MENU, ACTION_STOP):
@@ -70,13 +105,9 @@ class SkipSegmentDialogue(xbmcgui.WindowXMLDialog):
             return
 
         if control == OK_BUTTON:
-            remaining_seconds = self.player.getTotalTime() - self.seek_time_seconds
-
-            # We don't want to skip to the end of the video (give other addons time to play, like nextup service)
-            if remaining_seconds < MIN_REMAINING_SECONDS:
-                self.player.seekTime(self.player.getTotalTime() - MIN_REMAINING_SECONDS)
-                self.close()
+            if self.on_skip is not None:
+                self.on_skip(self.seek_time_seconds)
             else:
-                self.player.seekTime(self.seek_time_seconds)
+                seek_past_segment(self.player, self.seek_time_seconds)
 
         self.close()